@@ -1,36 +1,27 @@
 import asyncio
 import common
 import gpt
+import hashlib
+import imageproc
 import json
-import state
+import metrics
+import storage
+import template
 
-_logger = common.get_logger("Analysis")
-
-PROMPT_DIR = "prompts"
-
-# Common prompts
-_prompt_field_names    = None
-_prompt_analyse_images = None
-_prompt_correct        = None
-
-with open(f"{PROMPT_DIR}/field_names.txt", "r") as file:
-    _prompt_field_names = file.read()
+from collections import deque
+from storage import Config
+from typing import Callable, Optional
 
-with open(f"{PROMPT_DIR}/analyse_images.txt", "r") as file:
-    _prompt_analyse_images = file.read()
+_logger = common.get_logger("Analysis")
 
-with open(f"{PROMPT_DIR}/correct.txt", "r") as file:
-    _prompt_correct = file.read()
+_IMAGE_ANALYSIS_CACHE_TTL_S = 60 * 60 * 24 * 7
+_FIELD_NAMES_CACHE_TTL_S    = 60 * 60 * 24 * 30
 
 async def _get_field_names(info: list[str]) -> dict:
-    field_list = ""
-    field_num = 1
-
-    for field in info:
-        field_list += f"{field_num}) {field}\n"
+    field_list = "".join(f"{field_num}) {field}\n" for field_num, field in enumerate(info, 1))
 
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, gpt.request_json, _prompt_field_names, field_list)
+    return await gpt.request_json(template.load("field_names").text, field_list,
+                                  cache_ttl=_FIELD_NAMES_CACHE_TTL_S)
 
 STANDARD_REPORT_INFO = [
     "Product version (build, version, commit hash, etc.)",
@@ -46,95 +37,168 @@ STANDARD_REPORT_INFO_JSON = {
     "version": "Product version"
 }
 
+def _get_artifacts_key(config: Config) -> str:
+    # Rendered prompts depend on the templates too, so a prompt change invalidates them
+    key = config.fingerprint()
+
+    for name in ["field_names", "analyse_chat", "format_json", "structured_output"]:
+        key += template.load(name).hash
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def _render_analyse_chat_prompt(config: Config) -> str:
+    issue_info = STANDARD_REPORT_INFO + config.issue_extra_info
+
+    return template.load("analyse_chat").render(
+        product_name=config.product_name,
+        product_type=config.product_type,
+        info="\n".join("* " + field for field in issue_info),
+        categories="\n".join("  - " + category for category in config.issue_categories)
+    )
+
+def _render_structured_prompt(config: Config) -> str:
+    return _render_analyse_chat_prompt(config) + "\n\n" + template.load("structured_output").text
+
+def _make_issue_schema(field_names: dict, categories: list[str]) -> dict:
+    properties = {"_reasoning": {"type": "string"}, "_issue_found": {"type": "boolean"}}
+
+    for key, name in field_names.items():
+        properties[key] = {"type": "string", "description": name}
+
+    # Categories come straight from /setup, and a strict schema rejects empty or repeated enum values
+    categories = list(dict.fromkeys(category.strip() for category in categories if category.strip()))
+
+    if categories:
+        properties["category"] = {"type": "string", "description": "Category", "enum": categories}
+
+    return {
+        "name": "bug_report",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False
+        }
+    }
+
+def _render_format_json_prompt(field_names: dict) -> str:
+    return template.load("format_json").render(
+        fields=",\n    ".join('"' + key + '": "..."' for key in field_names)
+    )
+
 class AnalysisSuite:
     def __init__(self, guild_id: int) -> None:
         self._prompt_analyse_chat = None
         self._prompt_format_json  = None
+        self._prompt_structured   = None
+        self._issue_schema        = None
         self._field_names         = None
+        self._single_pass         = False
+        self._budget              = gpt.Budget()
         self._guild_id            = guild_id
 
-    async def _init(self) -> None:
-        await self._init_fields()
-        await self._init_prompts()
-
-    async def _init_fields(self) -> None:
-        config = await state.get_config(self._guild_id)
-        self.field_names = await _get_field_names(config.issue_extra_info)
+    async def _init(self, config: Config) -> None:
+        artifacts_key = _get_artifacts_key(config)
+        artifacts     = await storage.get_analysis_artifacts(self._guild_id)
 
-        if self.field_names == {}:
-            RuntimeError("Failed to get field names")
+        self._single_pass = config.single_pass_analysis
+        self._budget      = gpt.Budget(config.llm_cost_budget, config.llm_latency_budget)
 
-        self._field_names = {**self.field_names, **STANDARD_REPORT_INFO_JSON}
+        if artifacts and artifacts.get("key") == artifacts_key:
+            self._set_artifacts(artifacts)
+            return
 
-    async def _init_analyse_chat_prompt(self) -> None:
-        info_list     = ""
-        category_list = ""
+        field_names = await _get_field_names(config.issue_extra_info)
 
-        config = await state.get_config(self._guild_id)
+        if field_names == {}:
+            _logger.error(f"Failed to get field names for guild {self._guild_id}")
 
-        issue_info = STANDARD_REPORT_INFO + config.issue_extra_info
+        field_names = {**field_names, **STANDARD_REPORT_INFO_JSON}
 
-        for field in issue_info:
-            if info_list != "":
-                info_list += "\n* " + field
-            else:
-                info_list += "* " + field
-
-        for category in config.issue_categories:
-            if category_list != "":
-                category_list += "\n  - " + category
-            else:
-                category_list += "  - " + category
+        artifacts = {
+            "key"                 : artifacts_key,
+            "field_names"         : field_names,
+            "prompt_analyse_chat" : _render_analyse_chat_prompt(config),
+            "prompt_format_json"  : _render_format_json_prompt(field_names),
+            "prompt_structured"   : _render_structured_prompt(config),
+            "issue_schema"        : _make_issue_schema(field_names, config.issue_categories)
+        }
 
-        with open(f"{PROMPT_DIR}/analyse_chat.txt", "r") as file:
-            self._prompt_analyse_chat = file.read()
+        self._set_artifacts(artifacts)
 
-        self._prompt_analyse_chat = self._prompt_analyse_chat.replace("@product_name@", config.product_name)
-        self._prompt_analyse_chat = self._prompt_analyse_chat.replace("@product_type@", config.product_type)
-        self._prompt_analyse_chat = self._prompt_analyse_chat.replace("@info@",         info_list)
-        self._prompt_analyse_chat = self._prompt_analyse_chat.replace("@categories@",   category_list)
+        # Don't persist a failed field name lookup, retry it on the next init instead
+        if len(field_names) > len(STANDARD_REPORT_INFO_JSON) or not config.issue_extra_info:
+            await storage.set_analysis_artifacts(self._guild_id, artifacts)
 
-    def _init_format_json_prompt(self) -> None:
-        format_fields = ""
+    def _set_artifacts(self, artifacts: dict) -> None:
+        self._field_names         = artifacts["field_names"]
+        self._prompt_analyse_chat = artifacts["prompt_analyse_chat"]
+        self._prompt_format_json  = artifacts["prompt_format_json"]
+        self._prompt_structured   = artifacts["prompt_structured"]
+        self._issue_schema        = artifacts["issue_schema"]
 
-        for key in self._field_names:
-            if format_fields != "":
-                format_fields += ",\n    " + '"' + key + '": "..."'
-            else:
-                format_fields += '"' + key + '": "..."'
+    def estimate_size(self) -> int:
+        size = 0
 
-        with open(f"{PROMPT_DIR}/format_json.txt", "r") as file:
-            self._prompt_format_json = file.read()
+        for prompt in [self._prompt_analyse_chat, self._prompt_format_json, self._prompt_structured]:
+            size += len(prompt) if prompt else 0
 
-        self._prompt_format_json = self._prompt_format_json.replace("@fields@", format_fields)
+        for artifact in [self._field_names, self._issue_schema]:
+            size += len(json.dumps(artifact)) if artifact else 0
 
-    async def _init_prompts(self) -> None:
-        await self._init_analyse_chat_prompt()
-        self._init_format_json_prompt()
+        return size
 
     async def analyse_images(self, chat_log: str, image_urls: list[str]) -> str:
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, gpt.request, _prompt_analyse_images, chat_log, image_urls, 0.33,
-                                          "gpt-4-vision-preview")
+        with metrics.timed("image_analysis"):
+            images = await imageproc.prepare_images(image_urls)
+
+            return await gpt.request(template.load("analyse_images").text, chat_log, images, 0.33, "images",
+                                     cache_ttl=_IMAGE_ANALYSIS_CACHE_TTL_S, budget=self._budget)
 
-    async def analyse_issue(self, chat_log: str, hint: str) -> dict:
+    async def analyse_issue(self, chat_log: str, hint: str,
+                            on_progress: Optional[Callable[[str], None]] = None, temperature = 0.1) -> dict:
         analysis_input = "Chat log:\n```\n" + chat_log + "\n```\n\n"
         analysis_input += f"Developer hint: {hint if hint != '' else '<None>'}"
 
-        loop = asyncio.get_event_loop()
+        if self._single_pass:
+            return await self._analyse_issue_structured(analysis_input, temperature)
+
+        with metrics.timed("analysis"):
+            if on_progress:
+                analysis_parts = []
 
-        analysis = await loop.run_in_executor(None, gpt.request, self._prompt_analyse_chat, analysis_input)
+                async for part in gpt.request_stream(self._prompt_analyse_chat, analysis_input, [], temperature,
+                                                     budget=self._budget):
+                    analysis_parts.append(part)
+                    on_progress(part)
 
-        return await loop.run_in_executor(None, gpt.request_json, self._prompt_format_json, analysis)
+                analysis = "".join(analysis_parts)
+            else:
+                analysis = await gpt.request(self._prompt_analyse_chat, analysis_input, [], temperature,
+                                             budget=self._budget)
+
+        with metrics.timed("format_json"):
+            return await gpt.request_json(self._prompt_format_json, analysis, budget=self._budget)
+
+    async def _analyse_issue_structured(self, analysis_input: str, temperature: float) -> dict:
+        with metrics.timed("structured_analysis"):
+            issue = await gpt.request_structured(self._prompt_structured, analysis_input, self._issue_schema,
+                                                 temperature, self._budget)
+
+        if not issue.pop("_issue_found", False):
+            return {}
+
+        issue.pop("_reasoning", None)
+
+        return issue
 
     async def correct_analysis(self, analysis: dict, comment: str) -> dict:
         correct_input = "```json\n"
         correct_input += json.dumps(analysis, indent=4, ensure_ascii=False)
         correct_input += "```\n\nComment: " + comment
 
-        loop = asyncio.get_event_loop()
-
-        return await loop.run_in_executor(None, gpt.request_json, _prompt_correct, correct_input, "gpt-4-turbo-preview")
+        return await gpt.request_json(template.load("correct").text, correct_input, "correct", budget=self._budget)
 
     def make_markdown(self, issue: dict) -> tuple[str, str]:
         if "category" not in issue:
@@ -160,3 +224,73 @@ class AnalysisSuite:
             issue_md += "\n * " + self._field_names[key] + ": " + issue[key]
 
         return issue_title, issue_md
+
+# Alternatives are sampled hotter than the first analysis so they actually differ
+_CANDIDATE_TEMPERATURE = 0.7
+
+class IssueCandidatePool:
+    def __init__(self, analysis_suite: AnalysisSuite, chat_log: str, hint: str, size: int = 3,
+                 refill_threshold: int = 1) -> None:
+        self._analysis_suite   = analysis_suite
+        self._chat_log         = chat_log
+        self._hint             = hint
+        self._size             = size
+        self._refill_threshold = refill_threshold
+        self._ready            = deque()
+        self._pending          = set()
+
+    def fill(self, count: Optional[int] = None) -> None:
+        if count is None:
+            count = self._size - len(self._ready) - len(self._pending)
+
+        for _ in range(count):
+            candidate = self._analysis_suite.analyse_issue(self._chat_log, self._hint,
+                                                           temperature=_CANDIDATE_TEMPERATURE)
+            self._pending.add(asyncio.create_task(candidate))
+
+    def _collect(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+
+        if task.exception():
+            _logger.error(f"Failed to generate issue candidate: {task.exception()}")
+        elif task.result() != {}:
+            self._ready.append(task.result())
+
+    async def next(self) -> dict:
+        # Give up with an empty result after a whole pool's worth of unusable candidates
+        for _ in range(self._size):
+            if self._ready:
+                break
+
+            # Without prefetching only the one that's asked for is generated
+            if not self._pending:
+                self.fill(1 if self._refill_threshold < 0 else None)
+
+            done, self._pending = await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                self._collect(task)
+
+        if not self._ready:
+            return {}
+
+        candidate = self._ready.popleft()
+
+        if len(self._ready) + len(self._pending) <= self._refill_threshold:
+            self.fill()
+
+        return candidate
+
+    async def prefetch(self) -> None:
+        self.fill()
+
+        if self._pending:
+            await asyncio.wait(self._pending)
+
+    async def close(self) -> None:
+        for task in self._pending:
+            task.cancel()
+
+        await asyncio.gather(*self._pending, return_exceptions=True)
+        self._pending.clear()
@@ -0,0 +1,636 @@
+import argparse
+import asyncio
+import bugbot
+import chatproc
+import common
+import datetime
+import discord
+import ghclient
+import gpt
+import httpx
+import imageproc
+import io
+import itertools
+import json
+import logging
+import math
+import metrics
+import openai
+import random
+import re
+import resource
+import state
+import storage
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image
+from storage import Config
+
+# Offline load test, Discord, OpenAI, GitHub and MongoDB are replaced by in-process stand-ins
+
+_FAKE_WORDS = ("crash", "freeze", "login", "button", "screen", "save", "load", "error", "update", "menu", "sound",
+               "window", "server", "timeout", "version", "settings", "profile", "click", "black", "missing")
+
+_SCENARIOS  = ("history", "analysis", "report")
+
+_MAX_REVIEWS = 4
+
+_logger = logging.getLogger("Benchmark")
+
+_rng = random.Random()
+
+# Filled in by main()
+_args        = None
+_channels    = {}
+_message_ids = itertools.count(1)
+
+async def _sleep_latency(latency: float) -> None:
+    if latency > 0:
+        await asyncio.sleep(latency * _rng.uniform(1 - _args.jitter, 1 + _args.jitter))
+
+def _make_sentence(words: int) -> str:
+    return " ".join(_rng.choice(_FAKE_WORDS) for _ in range(words)).capitalize() + "."
+
+# Discord
+
+class _FakeAuthor:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+class _FakeAttachment:
+    def __init__(self, url: str) -> None:
+        self.url          = url
+        self.content_type = "image/png"
+
+class _FakeReference:
+    def __init__(self, message_id: int) -> None:
+        self.message_id = message_id
+        self.resolved   = None
+
+class _FakeConnectionState:
+    def _get_message(self, message_id: int) -> None:
+        return None
+
+_connection_state = _FakeConnectionState()
+
+# Subclassed so the isinstance checks in chatproc accept it
+class _FakeMessage(discord.Message):
+    def __init__(self, channel: "_FakeChannel", message_id: int, author: str, content: str,
+                 reply_to: int = None, attachments: list[_FakeAttachment] = []) -> None:
+        self.id          = message_id
+        self.channel     = channel
+        self.author      = _FakeAuthor(author)
+        self.content     = content
+        self.attachments = attachments
+        self.embeds      = []
+        self.reference   = _FakeReference(reply_to) if reply_to else None
+        self.type        = discord.MessageType.reply if reply_to else discord.MessageType.default
+        self._state      = _connection_state
+
+class _FakeChannel:
+    def __init__(self, guild_id: int, channel_id: int, num_messages: int) -> None:
+        self.id        = channel_id
+        self.guild_id  = guild_id
+        self._messages = []
+
+        authors = [f"user{i}" for i in range(_args.authors)]
+        start   = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+
+        for i in range(num_messages):
+            created_at  = start + datetime.timedelta(seconds=i * 10)
+            message_id  = discord.utils.time_snowflake(created_at) + i % 4096
+            reply_to    = None
+            attachments = []
+
+            # Replies reach back past the history window too, so some have to be fetched
+            if i and _rng.random() < _args.reply_rate:
+                reply_to = self._messages[max(0, i - _rng.randint(1, 80))].id
+
+            if _rng.random() < _args.image_rate:
+                attachments = [_FakeAttachment(f"https://cdn.discordapp.com/attachments/{channel_id}/{message_id}/"
+                                               f"image.png")]
+
+            self._messages.append(_FakeMessage(self, message_id, _rng.choice(authors),
+                                               _make_sentence(_rng.randint(4, 40)), reply_to, attachments))
+
+        self._by_id = {message.id: message for message in self._messages}
+
+    def get_report_start(self) -> _FakeMessage:
+        return _rng.choice(self._messages[:max(1, len(self._messages) - 50)])
+
+    async def history(self, limit: int, after: datetime.datetime | discord.Object):
+        if isinstance(after, datetime.datetime):
+            after = discord.Object(discord.utils.time_snowflake(after, high=True))
+
+        messages = [message for message in self._messages if message.id > after.id][:limit]
+
+        # Discord returns history in pages of 100 messages
+        for i, message in enumerate(messages):
+            if i % 100 == 0:
+                await _sleep_latency(_args.discord_latency)
+
+            yield message
+
+    async def fetch_message(self, message_id: int) -> _FakeMessage:
+        await _sleep_latency(_args.discord_latency)
+
+        if message_id not in self._by_id:
+            raise discord.NotFound(_FakeHTTPResponse(404), "Unknown Message")
+
+        return self._by_id[message_id]
+
+class _FakeHTTPResponse:
+    def __init__(self, status: int) -> None:
+        self.status = status
+        self.reason = "Not Found"
+
+class _FakeMessageHandle:
+    def __init__(self, interaction: "_FakeInteraction", content: str) -> None:
+        self._interaction = interaction
+        self.id           = next(_message_ids)
+        self.content      = content
+
+    async def edit(self, content: str = None, view: discord.ui.View = None) -> None:
+        await _sleep_latency(_args.discord_latency)
+
+        if content is not None:
+            self.content = content
+
+        # The only view a report shows is the draft review
+        if view is not None:
+            self._interaction.drafted = True
+            asyncio.create_task(self._interaction.review(self))
+
+class _FakeFollowup:
+    def __init__(self, interaction: "_FakeInteraction") -> None:
+        self._interaction = interaction
+
+    async def send(self, content: str, ephemeral: bool = False) -> _FakeMessageHandle:
+        await _sleep_latency(_args.discord_latency)
+        self._interaction.messages.append(content)
+        return _FakeMessageHandle(self._interaction, content)
+
+class _FakeResponse:
+    def __init__(self) -> None:
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, ephemeral: bool = False, thinking: bool = False) -> None:
+        self._done = True
+
+    async def send_message(self, content: str, ephemeral: bool = False) -> None:
+        self._done = True
+
+class _FakeGuild:
+    def __init__(self, guild_id: int) -> None:
+        self.id = guild_id
+
+class _FakeInteraction:
+    def __init__(self, guild_id: int) -> None:
+        self.id       = next(_message_ids)
+        self.guild    = _FakeGuild(guild_id)
+        self.response = _FakeResponse()
+        self.followup = _FakeFollowup(self)
+        self.messages = []
+        self.drafted  = False
+        self.reviews  = 0
+        self.reviewed = asyncio.Event()
+
+    async def review(self, message: _FakeMessageHandle) -> None:
+        await _sleep_latency(_args.review_time)
+
+        self.reviews += 1
+
+        # Give up on drafts that keep failing
+        if self.reviews > _MAX_REVIEWS:
+            self.reviewed.set()
+            return
+
+        action = "regenerate" if self.reviews == 1 and _rng.random() < _args.regenerate_rate else "confirm"
+        await bugbot.handle_draft_action(_FakeButtonInteraction(self, message), action)
+
+        if action == "confirm":
+            self.reviewed.set()
+
+class _FakeButtonInteraction:
+    def __init__(self, interaction: _FakeInteraction, message: _FakeMessageHandle) -> None:
+        self.guild    = interaction.guild
+        self.message  = message
+        self.response = _FakeResponse()
+        self.followup = interaction.followup
+
+    async def edit_original_response(self, content: str = None, view: discord.ui.View = None) -> None:
+        await self.message.edit(content, view)
+
+# OpenAI
+
+class _FakeObject:
+    def __init__(self, **values) -> None:
+        self.__dict__.update(values)
+
+_FORMAT_FIELD_PATTERN = re.compile(r'"(\w+)": "\.\.\."')
+_FIELD_LIST_PATTERN   = re.compile(r"^\d+\) (.*)$", re.MULTILINE)
+_JSON_BLOCK_PATTERN   = re.compile(r"```json\n(.*?)```", re.DOTALL)
+
+def _make_structured_response(schema: dict) -> dict:
+    response = {}
+
+    for key, field in schema["schema"]["properties"].items():
+        if field["type"] == "boolean":
+            response[key] = True
+        elif "enum" in field:
+            response[key] = _rng.choice(field["enum"])
+        else:
+            response[key] = _make_sentence(_rng.randint(4, 30))
+
+    return response
+
+def _make_json_response(system: str, prompt: str) -> dict:
+    # Reformatting an analysis lists the wanted fields in the prompt
+    format_fields = _FORMAT_FIELD_PATTERN.findall(system)
+
+    if format_fields:
+        return {key: (_rng.choice(["Crash", "UI"]) if key == "category" else _make_sentence(_rng.randint(4, 30)))
+                for key in format_fields}
+
+    # Corrections get the current report back
+    json_block = _JSON_BLOCK_PATTERN.search(prompt)
+
+    if json_block:
+        return json.loads(json_block.group(1))
+
+    return {f"extra_{i}": field[:30] for i, field in enumerate(_FIELD_LIST_PATTERN.findall(prompt), 1)}
+
+def _make_completion(content: str, prompt_tokens: int) -> _FakeObject:
+    usage = _FakeObject(prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4 + 1,
+                        total_tokens=prompt_tokens + len(content) // 4 + 1)
+
+    return _FakeObject(choices=[_FakeObject(message=_FakeObject(content=content))], usage=usage)
+
+async def _stream_completion(content: str):
+    words = content.split(" ")
+
+    for i in range(0, len(words), 8):
+        await _sleep_latency(_args.llm_latency / max(1, len(words) // 8))
+        yield _FakeObject(choices=[_FakeObject(delta=_FakeObject(content=" ".join(words[i:i + 8]) + " "))])
+
+class _FakeCompletions:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.failures = 0
+
+    async def create(self, model: str, messages: list[dict], temperature: float, max_tokens: int,
+                     response_format: dict = None, stream: bool = False) -> _FakeObject:
+        self.requests += 1
+
+        system        = messages[0]["content"]
+        prompt        = messages[1]["content"][0]["text"]
+        prompt_tokens = (len(system) + len(prompt)) // 4 + 1
+
+        if _rng.random() < _args.llm_failure_rate:
+            await _sleep_latency(_args.llm_latency / 2)
+            self.failures += 1
+            raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+        if stream:
+            return _stream_completion(" ".join(_make_sentence(12) for _ in range(_rng.randint(8, 24))))
+
+        await _sleep_latency(_args.llm_latency)
+
+        if response_format is None:
+            return _make_completion(" ".join(_make_sentence(12) for _ in range(_rng.randint(2, 8))), prompt_tokens)
+
+        if response_format["type"] == "json_schema":
+            content = _make_structured_response(response_format["json_schema"])
+        else:
+            content = _make_json_response(system, prompt)
+
+        return _make_completion(json.dumps(content), prompt_tokens)
+
+def _make_png(seed: str) -> bytes:
+    image_rng = random.Random(seed)
+    image     = Image.new("RGB", (image_rng.randint(400, 2400), image_rng.randint(300, 1400)))
+    image.paste((image_rng.randrange(256), image_rng.randrange(256), image_rng.randrange(256)),
+                (0, 0, image.width // 2, image.height))
+
+    data = io.BytesIO()
+    image.save(data, format="PNG")
+
+    return data.getvalue()
+
+async def _fake_download(url: str) -> bytes:
+    await _sleep_latency(_args.discord_latency)
+    return await asyncio.to_thread(_make_png, url)
+
+# GitHub
+
+class _FakeGitHub:
+    def __init__(self) -> None:
+        self.issues = {}
+
+    async def get_repo_full_name(self, repo_name: str) -> str:
+        await _sleep_latency(_args.github_latency)
+        return repo_name
+
+    async def create_issue(self, repo_name: str, title: str, body: str, labels: list[str] = []) -> str:
+        await _sleep_latency(_args.github_latency)
+
+        number = self.issues[repo_name] = self.issues.get(repo_name, 0) + 1
+
+        return f"https://github.com/{repo_name}/issues/{number}"
+
+    async def add_comment(self, repo_name: str, number: int, body: str) -> str:
+        await _sleep_latency(_args.github_latency)
+        return f"https://github.com/{repo_name}/issues/{number}#issuecomment-1"
+
+    async def get_open_issues(self, repo_name: str) -> list[tuple[int, str, str, str]]:
+        await _sleep_latency(_args.github_latency)
+        return []
+
+# MongoDB
+
+class _FakeStorage:
+    def __init__(self) -> None:
+        self.configs    = {}
+        self.artifacts  = {}
+        self.llm_cache  = {}
+        self.issues     = {}
+        self.drafts     = {}
+
+    def _make_config(self, guild_id: int) -> Config:
+        config = Config()
+
+        config.github_repo            = f"bench/repo-{guild_id}"
+        config.issue_categories       = ["Crash", "UI", "Performance"]
+        config.issue_extra_info       = ["Operating system", "Steps to reproduce"]
+        config.max_concurrent_reports = _args.guild_concurrency
+        config.single_pass_analysis   = _args.single_pass
+
+        return config
+
+    async def get_config(self, guild_id: int) -> Config:
+        await _sleep_latency(_args.mongo_latency)
+
+        if guild_id not in self.configs:
+            self.configs[guild_id] = self._make_config(guild_id).to_dict()
+
+        return Config(self.configs[guild_id])
+
+    async def get_configs(self, guild_ids: list[int]) -> dict[int, Config]:
+        return {guild_id: await self.get_config(guild_id) for guild_id in guild_ids}
+
+    async def set_config(self, guild_id: int, config: Config) -> None:
+        self.configs[guild_id] = config.to_dict()
+
+    async def flush(self) -> None:
+        pass
+
+    async def get_analysis_artifacts(self, guild_id: int) -> dict | None:
+        await _sleep_latency(_args.mongo_latency)
+        return self.artifacts.get(guild_id)
+
+    async def set_analysis_artifacts(self, guild_id: int, artifacts: dict) -> None:
+        await _sleep_latency(_args.mongo_latency)
+        self.artifacts[guild_id] = artifacts
+
+    async def get_llm_result(self, key: str) -> str | dict | None:
+        await _sleep_latency(_args.mongo_latency)
+        return self.llm_cache.get(key)
+
+    async def put_llm_result(self, key: str, result: str | dict, ttl: int) -> None:
+        await _sleep_latency(_args.mongo_latency)
+        self.llm_cache[key] = result
+
+    async def put_draft(self, draft_id: int, draft: dict) -> None:
+        await _sleep_latency(_args.mongo_latency)
+        self.drafts[draft_id] = {**draft, "locked": False}
+
+    async def lock_draft(self, draft_id: int, ttl: float) -> dict | None:
+        await _sleep_latency(_args.mongo_latency)
+
+        draft = self.drafts.get(draft_id)
+
+        if draft is None or draft["locked"]:
+            return None
+
+        draft["locked"] = True
+
+        return dict(draft)
+
+    async def unlock_draft(self, draft_id: int, changes: dict = {}) -> None:
+        await _sleep_latency(_args.mongo_latency)
+
+        if draft_id in self.drafts:
+            self.drafts[draft_id].update(changes, locked=False)
+
+    async def delete_draft(self, draft_id: int) -> None:
+        await _sleep_latency(_args.mongo_latency)
+        self.drafts.pop(draft_id, None)
+
+    async def put_indexed_issue(self, repo: str, number: int, issue: dict) -> None:
+        await _sleep_latency(_args.mongo_latency)
+        self.issues[f"{repo}#{number}"] = {"repo": repo, "number": number, **issue}
+
+    async def find_indexed_issues(self, repo: str, bands: list[str]) -> list[dict]:
+        await _sleep_latency(_args.mongo_latency)
+
+        bands = set(bands)
+
+        return [issue for issue in self.issues.values() if issue["repo"] == repo and bands & set(issue["bands"])]
+
+def _install_fakes() -> _FakeCompletions:
+    fake_storage = _FakeStorage()
+
+    for name in ["get_config", "get_configs", "set_config", "flush", "get_analysis_artifacts",
+                 "set_analysis_artifacts", "get_llm_result", "put_llm_result", "put_draft", "lock_draft",
+                 "unlock_draft", "delete_draft", "put_indexed_issue", "find_indexed_issues"]:
+        setattr(storage, name, getattr(fake_storage, name))
+
+    fake_github = _FakeGitHub()
+
+    for name in ["get_repo_full_name", "create_issue", "add_comment", "get_open_issues"]:
+        setattr(ghclient, name, getattr(fake_github, name))
+
+    completions = _FakeCompletions()
+    gpt._openai_client = _FakeObject(chat=_FakeObject(completions=completions))
+
+    if not _args.rate_limits:
+        gpt._MODEL_LIMITS         = {}
+        gpt._DEFAULT_MODEL_LIMITS = (1 << 20, 1 << 30, 1 << 40)
+
+    # tiktoken downloads its vocabulary on first use, the estimate keeps the harness offline
+    gpt.count_tokens = gpt.estimate_tokens
+
+    imageproc.DIR_IMAGE_CACHE = tempfile.mkdtemp(prefix="bugbot-bench-")
+    imageproc._download       = _fake_download
+
+    for guild_id in range(1, _args.guilds + 1):
+        channel_id = 1000 + guild_id
+        _channels[channel_id] = _FakeChannel(guild_id, channel_id, _args.history_size)
+
+    return completions
+
+# Runner
+
+class _Result:
+    def __init__(self, scenario: str) -> None:
+        self.scenario  = scenario
+        self.latencies = []
+        self.failures  = 0
+        self.timeouts  = 0
+        self.elapsed   = 0
+        self.peak_rss  = 0
+        self.peak_heap = 0
+
+def _get_percentile(samples: list[float], percentile: float) -> float:
+    if not samples:
+        return 0
+
+    # Nearest rank
+    samples = sorted(samples)
+    return samples[max(0, math.ceil(percentile / 100 * len(samples)) - 1)]
+
+def _get_peak_rss() -> int:
+    # Peak of the whole process so far, so later scenarios include the earlier ones. Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def _run_history(channel: _FakeChannel) -> bool:
+    config = await storage.get_config(channel.guild_id)
+    await chatproc.get_history(channel.guild_id, channel.get_report_start(), 50, 3, config.chat_token_budget)
+
+    return True
+
+async def _run_analysis(channel: _FakeChannel) -> bool:
+    chat_log = "\n".join(f"{message.author.name}: {message.content}" for message in channel._messages[:50])
+    analysis_suite = await state.get_analysis_suite(channel.guild_id)
+
+    return await analysis_suite.analyse_issue(chat_log, "None", lambda part: None) != {}
+
+async def _run_report(channel: _FakeChannel) -> bool:
+    interaction = _FakeInteraction(channel.guild_id)
+    message     = channel.get_report_start()
+
+    await bugbot.new_report.callback(interaction, f"https://discord.com/channels/{channel.guild_id}/{channel.id}/"
+                                                  f"{message.id}", "None")
+
+    # Reports finish when their draft is filed, which happens after the report slot is released
+    if interaction.drafted:
+        await interaction.reviewed.wait()
+
+    return any(message.startswith("Bug report filed") for message in interaction.messages)
+
+async def _run_scenario(scenario: str) -> _Result:
+    run       = {"history": _run_history, "analysis": _run_analysis, "report": _run_report}[scenario]
+    result    = _Result(scenario)
+    semaphore = asyncio.Semaphore(_args.concurrency)
+    channels  = list(_channels.values())
+
+    async def run_one(index: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+
+            # A hung run counts as a failure instead of stalling the whole benchmark
+            try:
+                succeeded = await asyncio.wait_for(run(channels[index % len(channels)]), _args.timeout)
+            except asyncio.TimeoutError:
+                _logger.warning(f"{scenario} run timed out after {_args.timeout}s")
+                result.timeouts += 1
+                succeeded        = False
+            except Exception as e:
+                _logger.debug(f"{scenario} run failed: {e}")
+                succeeded = False
+
+            result.latencies.append(time.perf_counter() - start)
+            result.failures += not succeeded
+
+    if _args.tracemalloc:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(i) for i in range(_args.reports)))
+    result.elapsed = time.perf_counter() - start
+
+    if _args.tracemalloc:
+        result.peak_heap = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result.peak_rss = _get_peak_rss()
+
+    return result
+
+def _print_result(result: _Result) -> None:
+    count = len(result.latencies)
+
+    print(f"{result.scenario:<10} runs {count:>5}  failed {result.failures:>4}  "
+          f"timed out {result.timeouts:>4}  "
+          f"p50 {_get_percentile(result.latencies, 50) * 1000:>8.1f}ms  "
+          f"p95 {_get_percentile(result.latencies, 95) * 1000:>8.1f}ms  "
+          f"p99 {_get_percentile(result.latencies, 99) * 1000:>8.1f}ms  "
+          f"{count / result.elapsed if result.elapsed else 0:>7.1f}/s  "
+          f"process peak rss {result.peak_rss / (1 << 20):>7.1f}MiB"
+          + (f"  peak heap {result.peak_heap / (1 << 20):.1f}MiB" if _args.tracemalloc else ""))
+
+def _print_stages() -> None:
+    print("\nStage latency (all scenarios)")
+
+    for (stage,) in sorted(metrics.stage_seconds.label_sets()):
+        print(f"  {stage:<20} n {metrics.stage_seconds.get_count(stage):>6}  "
+              f"p50 <= {metrics.stage_seconds.get_quantile(0.5, stage):g}s  "
+              f"p95 <= {metrics.stage_seconds.get_quantile(0.95, stage):g}s")
+
+async def _main() -> None:
+    completions = _install_fakes()
+    state.init()
+
+    for scenario in _args.scenarios:
+        _print_result(await _run_scenario(scenario))
+
+    _print_stages()
+
+    print(f"\nLLM requests {completions.requests}, injected failures {completions.failures}")
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test with simulated Discord, OpenAI and GitHub")
+
+    parser.add_argument("--scenarios", nargs="+", choices=_SCENARIOS, default=list(_SCENARIOS))
+    parser.add_argument("--guilds", type=int, default=20, help="simulated guilds, one channel each")
+    parser.add_argument("--reports", type=int, default=200, help="runs per scenario, spread over the guilds")
+    parser.add_argument("--concurrency", type=int, default=32, help="runs in flight at once")
+    parser.add_argument("--guild-concurrency", type=int, default=1, help="max concurrent reports per guild")
+    parser.add_argument("--history-size", type=int, default=500, help="messages per channel")
+    parser.add_argument("--authors", type=int, default=6, help="distinct authors per channel")
+    parser.add_argument("--reply-rate", type=float, default=0.2)
+    parser.add_argument("--image-rate", type=float, default=0.02)
+    parser.add_argument("--regenerate-rate", type=float, default=0.2, help="reports regenerated once")
+    parser.add_argument("--single-pass", action="store_true", help="use single pass structured analysis")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per OpenAI request")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--github-latency", type=float, default=0.3)
+    parser.add_argument("--mongo-latency", type=float, default=0.002)
+    parser.add_argument("--review-time", type=float, default=0.1, help="seconds until a review button is pressed")
+    parser.add_argument("--jitter", type=float, default=0.3, help="relative latency jitter")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the real per-model OpenAI limits")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the peak Python heap (slower)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds until a run counts as failed")
+    parser.add_argument("--seed", type=int, default=1)
+
+    return parser.parse_args()
+
+def main() -> None:
+    global _args
+
+    _args = _parse_args()
+    _rng.seed(_args.seed)
+
+    common.set_console_level(logging.WARNING)
+    bugbot.client.get_channel = lambda channel_id: _channels.get(channel_id)
+
+    asyncio.run(_main())
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,254 @@
 import asyncio
 import chatproc
 import common
+import datetime
+import dedupe
 import discord
+import ghclient
 import gpt
 import logging
+import metrics
 import os
 import re
+import scan
+import socket
 import state
 import storage
 import time
+import uuid
 
+from analysis import AnalysisSuite
+from analysis import IssueCandidatePool
+from cache import LRUCache
 from discord import app_commands
 from dotenv import load_dotenv
-from github import Auth
-from github import Github
-from github import GithubIntegration
 from storage import Config
 from typing import Optional
 
 # Logging
 
 DIR_LOGS = "logs"
-LOG_PATH = f"{DIR_LOGS}/{time.strftime('%Y%m%d-%H%M%S')}.log"
 
-os.makedirs(DIR_LOGS, exist_ok = True)
-
-log_file_handler = logging.FileHandler(LOG_PATH, mode = "w", encoding = "utf-8")
-log_file_handler.setLevel(logging.DEBUG)
-log_file_handler.setFormatter(logging.Formatter(common.LOG_FORMAT))
-
-log_console_handler = logging.StreamHandler()
-log_console_handler.setLevel(logging.INFO)
-log_console_handler.setFormatter(logging.Formatter(common.LOG_FORMAT))
+common.init_logging(DIR_LOGS)
 
 _logger = logging.getLogger()
-_logger.setLevel(logging.DEBUG)
-_logger.addHandler(log_file_handler)
-_logger.addHandler(log_console_handler)
 
 load_dotenv()
-gpt.init(os.getenv('OPENAI_API_KEY'))
-storage.init(os.getenv('MONGO_URI'))
 
-class MyClient(discord.Client):
-    def __init__(self, *, intents: discord.Intents):
-        super().__init__(intents=intents)
+class MyClient(discord.AutoShardedClient):
+    def __init__(self, *, intents: discord.Intents, shard_count: int = None, shard_ids: list[int] = None):
+        super().__init__(intents=intents, shard_count=shard_count, shard_ids=shard_ids)
         self.tree = app_commands.CommandTree(self)
 
+    async def setup_hook(self) -> None:
+        start = time.perf_counter()
+
+        gpt.init(os.getenv('OPENAI_API_KEY'))
+
+        # Services don't depend on each other, so connect to all of them while the gateway is still logging in
+        services = [storage.init(os.getenv('MONGO_URI')),
+                    asyncio.to_thread(ghclient.init, os.getenv('GITHUB_APP_ID'),
+                                      f"certs/{os.getenv('GITHUB_APP_KEY')}"),
+                    asyncio.to_thread(gpt.load_encoding)]
+
+        if os.getenv('METRICS_PORT'):
+            services.append(metrics.start_server(os.getenv('METRICS_HOST', "127.0.0.1"),
+                                                 int(os.getenv('METRICS_PORT'))))
+
+        await asyncio.gather(*services)
+
+        # Buttons of drafts that were waiting for review before a restart keep working
+        self.add_view(DraftReview())
+
+        _logger.info(f"Services initialised in {time.perf_counter() - start:.2f}s")
+
+    async def close(self) -> None:
+        try:
+            await storage.flush()
+        finally:
+            await metrics.stop_server()
+            await chatproc.close()
+            await super().close()
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-client = MyClient(intents=intents)
+# Processes that only run some of the shards coordinate reports through Mongo leases
+shard_count = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+shard_ids   = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(",")] if os.getenv('SHARD_IDS') else None
+lease_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}" if shard_ids else None
 
-async def gh_open(guild_id: int = 0, repo: str = "") -> Github:
-    gh_key = ""
+client = MyClient(intents=intents, shard_count=shard_count, shard_ids=shard_ids)
 
-    with open(f"certs/{os.getenv('GITHUB_APP_KEY')}", "r") as file:
-        gh_key = file.read()
+# Successful config verifications are trusted for this long before being rechecked in the background
+_CONFIG_VERIFY_TTL_S = 60 * 30
 
-    gh_auth = Auth.AppAuth(os.getenv('GITHUB_APP_ID'), gh_key)
-    gh_integration = GithubIntegration(auth=gh_auth)
+_config_revalidations = {}
 
-    if guild_id:
-        config = await state.get_config(guild_id)
-        repo = config.github_repo.split("/")
-    else:
-        repo = repo.split("/")
+# Streamed previews are edited at most this often to stay within Discord's rate limits
+_PREVIEW_EDIT_INTERVAL_S = 1.5
+_PREVIEW_MAX_LENGTH      = 1800
+
+# Number of alternative reports kept ready for Regenerate in guilds that prefetch them, for the most recent
+# drafts only
+_REGENERATE_CANDIDATES   = 2
+_MAX_CANDIDATE_POOLS     = 256
+_CANDIDATE_POOL_TTL_S    = 60 * 60
+
+# A draft stays locked while a button press is handled, longer than any regeneration takes. Regenerate and Correct
+# only lock it once they hold a report slot
+_DRAFT_LOCK_S            = 60 * 5
+
+_candidate_pools = LRUCache(_MAX_CANDIDATE_POOLS, _CANDIDATE_POOL_TTL_S)
+
+# Guilds whose state is built in the background after startup, so their first report doesn't pay for it
+_PREWARM_MAX_GUILDS       = 500
+_PREWARM_CONCURRENCY      = 8
+
+_prewarm_task = None
+
+# Scan progress is shown this often, drafts are cut to fit a Discord message
+_SCAN_PROGRESS_INTERVAL_S = 3
+_SCAN_DRAFT_MAX_LENGTH    = 1500
+
+class ProgressMessage:
+    def __init__(self, message: discord.WebhookMessage, header: str) -> None:
+        self._message = message
+        self._header  = header
+        self._parts   = []
+        self._pending = False
+        self._closed  = False
+        self._task    = None
+
+    def append(self, text: str) -> None:
+        self._parts.append(text)
+        self._pending = True
+
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        # Every edit carries everything received so far, so intermediate updates are simply dropped
+        while self._pending and not self._closed:
+            await asyncio.sleep(_PREVIEW_EDIT_INTERVAL_S)
+            self._pending = False
+
+            preview = "".join(self._parts)[-_PREVIEW_MAX_LENGTH:]
+
+            try:
+                await self._message.edit(content=f"{self._header}\n\n{preview}")
+            except discord.HTTPException as e:
+                _logger.warning(f"Failed to update preview: {e}")
+
+        self._task = None
+
+    async def close(self) -> None:
+        self._closed = True
 
-    gh_installation = gh_integration.get_repo_installation(repo[0], repo[1])
-    return gh_installation.get_github_for_installation()
+        if self._task:
+            self._task.cancel()
 
-async def file_issue(guild_id: int, issue_title: str, issue_md: str) -> str:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+async def file_issue(guild_id: int, issue_title: str, issue_md: str, issue_text: str) -> str:
     config = await state.get_config(guild_id)
 
-    gh = await gh_open(guild_id=guild_id)
-    repo = gh.get_repo(config.github_repo)
+    with metrics.timed("github_file"):
+        issue_url = await ghclient.create_issue(config.github_repo, issue_title, issue_md, labels=["bug"])
+
+    try:
+        await dedupe.add_issue(config.github_repo, dedupe.get_issue_number(issue_url), issue_title, issue_url,
+                               issue_text)
+    except Exception as e:
+        _logger.error(f"Failed to index issue {issue_url}: {e}")
+
+    return issue_url
+
+async def find_duplicates(guild_id: int, issue_text: str) -> list[dedupe.Duplicate]:
+    config = await state.get_config(guild_id)
+
+    try:
+        return await dedupe.find_duplicates(config.github_repo, issue_text)
+    except Exception as e:
+        _logger.error(f"Failed to look up duplicates: {e}")
+        return []
+
+def format_duplicates(duplicates: list[dedupe.Duplicate]) -> str:
+    if not duplicates:
+        return ""
+
+    lines = [f"- [{duplicate.title}](<{duplicate.url}>) ({duplicate.similarity:.0%} similar)"
+             for duplicate in duplicates]
+
+    return "Possible duplicates:\n" + "\n".join(lines) + "\n\n"
+
+def format_stats() -> str:
+    lines = ["**Stage latency** (p50 / p95)"]
+
+    for (stage,) in sorted(metrics.stage_seconds.label_sets()):
+        p50 = metrics.stage_seconds.get_quantile(0.5, stage)
+        p95 = metrics.stage_seconds.get_quantile(0.95, stage)
+        lines.append(f"- {stage}: {p50:g}s / {p95:g}s ({metrics.stage_seconds.get_count(stage)} samples)")
+
+    usage = {}
+
+    for (model, _, kind), tokens in metrics.llm_tokens.items():
+        usage.setdefault(model, [0, 0, 0])[0 if kind == "prompt" else 1] += tokens
+
+    for (model, _), cost in metrics.llm_cost.items():
+        usage.setdefault(model, [0, 0, 0])[2] += cost
+
+    lines.append("\n**LLM usage**")
+
+    for model, (prompt_tokens, completion_tokens, cost) in sorted(usage.items()):
+        lines.append(f"- {model}: {prompt_tokens:.0f} prompt + {completion_tokens:.0f} completion tokens, ${cost:.2f}")
+
+    routes = {}
+
+    for (task, model, _), count in metrics.llm_routes.items():
+        routes.setdefault(task, {}).setdefault(model, [0, 0])[0] += count
+
+    for (task, model, _), count in metrics.llm_fallbacks.items():
+        routes.setdefault(task, {}).setdefault(model, [0, 0])[1] += count
+
+    lines.append("\n**Model routing** (requests / fallbacks)")
+
+    for task, models in sorted(routes.items()):
+        lines.append(f"- {task}: " + ", ".join(f"{model} {requests:.0f} / {fallbacks:.0f}"
+                                              for model, (requests, fallbacks) in sorted(models.items())))
 
-    new_issue = repo.create_issue(title=issue_title, body=issue_md, labels=["bug"])
+    state_stats = state.get_cache_stats()
+    state_total = state_stats["hits"] + state_stats["misses"]
 
-    gh.close()
+    lines.append("\n**Caches** (hit rate)")
 
-    return new_issue.html_url
+    for cache in ("llm", "image", "embed", "history"):
+        lines.append(f"- {cache}: {metrics.get_cache_hit_rate(cache):.0%}")
+
+    lines.append(f"- guild state: {state_stats['hits'] / state_total if state_total else 0:.0%}, "
+                 f"{state_stats['entries']} entries")
+
+    lines.append(f"\n**Reports**: {state_stats['active']} running, {state_stats['queued']} queued")
+
+    for (result,), count in sorted(metrics.reports.items()):
+        lines.append(f"- {result}: {count:.0f}")
+
+    return "\n".join(lines)
 
 async def verify_config(guild_id: int, config: Config = None) -> str:
     if config.github_repo == "":
         return "github_repo"
 
     try:
-        gh = await gh_open(repo=config.github_repo)
+        repo_name = await ghclient.get_repo_full_name(config.github_repo)
     except Exception as e:
         _logger.error(f"Error opening GitHub: {e}")
         return "github_repo"
 
-    repo_name = gh.get_repo(config.github_repo).full_name
-
     if repo_name != config.github_repo:
         return "github_repo"
 
@@ -112,12 +266,51 @@ async def verify_config(guild_id: int, config: Config = None) -> str:
 
     return None
 
-async def check_config(interaction: discord.Interaction, config: Config) -> bool:
-    config_error = await verify_config(interaction.guild.id, config)
+async def _revalidate_config(guild_id: int, config: Config) -> None:
+    try:
+        if await verify_config(guild_id, config) is None:
+            await state.set_config_verification(guild_id, config.fingerprint())
+        else:
+            # Force a blocking check on the next report so the error gets shown
+            await state.set_config_verification(guild_id, "")
+    except Exception as e:
+        _logger.error(f"Error revalidating configuration: {e}")
+    finally:
+        del _config_revalidations[guild_id]
+
+async def get_config_error(guild_id: int, config: Config) -> str:
+    fingerprint = config.fingerprint()
+    verified_at = await state.get_config_verification(guild_id, fingerprint)
+
+    # Only successful verifications are cached, so fixing a broken config takes effect immediately
+    if verified_at is None:
+        config_error = await verify_config(guild_id, config)
+
+        if config_error is None:
+            await state.set_config_verification(guild_id, fingerprint)
+
+        return config_error
+
+    if time.time() - verified_at > _CONFIG_VERIFY_TTL_S and guild_id not in _config_revalidations:
+        _config_revalidations[guild_id] = asyncio.create_task(_revalidate_config(guild_id, config))
+
+    return None
+
+async def check_config(interaction: discord.Interaction, config: Config, cached: bool = True) -> bool:
+    if cached:
+        config_error = await get_config_error(interaction.guild.id, config)
+    else:
+        config_error = await verify_config(interaction.guild.id, config)
 
     if config_error:
-        await interaction.response.send_message(f"Configuration error: {config.get_pretty_name(config_error)}",
-                                                ephemeral=True)
+        error_message = f"Configuration error: {config.get_pretty_name(config_error)}"
+
+        # Commands that take a while defer their response first
+        if interaction.response.is_done():
+            await interaction.followup.send(error_message, ephemeral=True)
+        else:
+            await interaction.response.send_message(error_message, ephemeral=True)
+
         return False
 
     return True
@@ -135,7 +328,7 @@ class Setup(discord.ui.Modal, title="Setup"):
         self.developer_role   = None
 
     async def populate(self, guild_id: int) -> None:
-        self.config = state.get_config(guild_id)
+        self.config = Config((await state.get_config(guild_id)).to_dict())
 
         self.repo = discord.ui.TextInput(label=self.config.get_pretty_name("github_repo"),
                                          style=discord.TextStyle.short,
@@ -186,8 +379,9 @@ class Setup(discord.ui.Modal, title="Setup"):
 
         self.submitted = True
 
-        if await check_config(interaction, self.config):
-            state.set_config(interaction.guild.id, self.config)
+        if await check_config(interaction, self.config, cached=False):
+            await state.set_config(interaction.guild.id, self.config)
+            await state.set_config_verification(interaction.guild.id, self.config.fingerprint())
             await interaction.response.send_message(f"Setup complete", ephemeral=True)
 
 class BugCorrect(discord.ui.Modal, title="Correct bug report"):
@@ -197,51 +391,328 @@ class BugCorrect(discord.ui.Modal, title="Correct bug report"):
                                    max_length=400,
                                    required=False)
 
-    submitted = False
-
     async def on_submit(self, interaction: discord.Interaction):
-        self.submitted = True
-        await interaction.response.send_message(f"Preparing bug report...", ephemeral=True)
+        await handle_draft_action(interaction, "correct", self.comment.value)
 
-class Confirm(discord.ui.View):
-    def __init__(self):
-        super().__init__()
-        self.value = None
-        self.comment = None
+class DraftReview(discord.ui.View):
+    # Registered once at startup and shared by all drafts, the draft is looked up by the message the button is on
+    def __init__(self) -> None:
+        super().__init__(timeout=None)
 
-    @discord.ui.button(label='Confirm', style=discord.ButtonStyle.green)
+    @discord.ui.button(label='Confirm', style=discord.ButtonStyle.green, custom_id="draft:confirm")
     async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.value = "confirm"
-        self.stop()
+        await handle_draft_action(interaction, "confirm")
 
-    @discord.ui.button(label='Regenerate', style=discord.ButtonStyle.blurple)
+    @discord.ui.button(label='Regenerate', style=discord.ButtonStyle.blurple, custom_id="draft:regenerate")
     async def regenerate(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.value = "regenerate"
-        self.stop()
+        await handle_draft_action(interaction, "regenerate")
 
-    @discord.ui.button(label='Correct', style=discord.ButtonStyle.blurple)
+    @discord.ui.button(label='Correct', style=discord.ButtonStyle.blurple, custom_id="draft:correct")
     async def correct(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.value = "correct"
-        correct_modal = BugCorrect()
-        await interaction.response.send_modal(correct_modal)
+        await interaction.response.send_modal(BugCorrect())
 
-        while not correct_modal.submitted:
-            await asyncio.sleep(1)
+    @discord.ui.button(label='Cancel', style=discord.ButtonStyle.grey, custom_id="draft:cancel")
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await handle_draft_action(interaction, "cancel")
 
-        self.comment = correct_modal.comment.value
-        self.stop()
+    @discord.ui.button(label='Add to issue', style=discord.ButtonStyle.green, custom_id="draft:comment")
+    async def add_comment(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await handle_draft_action(interaction, "comment")
 
-    @discord.ui.button(label='Cancel', style=discord.ButtonStyle.grey)
-    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.value = "cancel"
-        self.stop()
+def make_draft_view(draft: dict) -> DraftReview:
+    view = DraftReview()
+
+    if draft["duplicates"]:
+        view.add_comment.label = f"Add to #{draft['duplicates'][0]['number']}"
+    else:
+        view.remove_item(view.add_comment)
+
+    return view
+
+def format_draft(draft: dict) -> str:
+    duplicates = [dedupe.Duplicate(**duplicate) for duplicate in draft["duplicates"]]
+    return f"Confirm bug report?\n\n{format_duplicates(duplicates)}{draft['markdown']}"
+
+async def set_draft_issue(guild_id: int, analysis_suite: AnalysisSuite, draft: dict, issue: dict) -> bool:
+    markdown = analysis_suite.make_markdown(issue) if issue else None
+
+    if markdown is None:
+        return False
+
+    duplicates = await find_duplicates(guild_id, dedupe.get_issue_text(issue))
+
+    draft["issue"]                    = issue
+    draft["title"], draft["markdown"] = markdown
+    draft["duplicates"]               = [vars(duplicate) for duplicate in duplicates]
+
+    return True
+
+async def close_draft(draft_id: int) -> None:
+    await storage.delete_draft(draft_id)
+
+    candidates = _candidate_pools.pop(draft_id)
+
+    if candidates:
+        await candidates.close()
+
+def make_candidate_pool(analysis_suite: AnalysisSuite, draft: dict, size: int) -> IssueCandidatePool:
+    # Alternatives are only generated ahead by prefetch_candidates, which holds a report slot meanwhile
+    return IssueCandidatePool(analysis_suite, draft["chat_log"], draft["hint"], size, refill_threshold=-1)
+
+async def prefetch_candidates(guild_id: int, candidates: IssueCandidatePool) -> None:
+    try:
+        async with state.report_job(guild_id):
+            await candidates.prefetch()
+    except Exception as e:
+        _logger.error(f"Failed to prefetch alternatives for guild {guild_id}: {e}")
+
+async def rework_draft(draft_id: int, draft: dict, action: str, comment: str) -> bool:
+    analysis_suite = await state.get_analysis_suite(draft["guild_id"])
+
+    if action == "correct":
+        issue = await analysis_suite.correct_analysis(draft["issue"], comment)
+    else:
+        candidates = _candidate_pools.get(draft_id)
+
+        # Prefetched alternatives are only kept in memory, after a restart they are generated on demand
+        if candidates is None:
+            candidates = make_candidate_pool(analysis_suite, draft, 1)
+            _candidate_pools.put(draft_id, candidates)
+
+        issue = await candidates.next()
+
+    return await set_draft_issue(draft["guild_id"], analysis_suite, draft, issue)
+
+async def run_draft_action(interaction: discord.Interaction, draft_id: int, draft: dict, action: str,
+                           comment: str) -> None:
+    guild_id = draft["guild_id"]
+    config   = await state.get_config(guild_id)
+
+    match action:
+        case "confirm":
+            await interaction.edit_original_response(view=None)
+            issue_url = await file_issue(guild_id, draft["title"], draft["markdown"],
+                                         dedupe.get_issue_text(draft["issue"]))
+            await close_draft(draft_id)
+            await interaction.followup.send(f"Bug report filed:\n{issue_url}")
+            metrics.reports.inc("filed")
+        case "comment":
+            await interaction.edit_original_response(view=None)
+            comment_url = await ghclient.add_comment(config.github_repo, draft["duplicates"][0]["number"],
+                                                     draft["markdown"])
+            await close_draft(draft_id)
+            await interaction.followup.send(f"Bug report added to existing issue:\n{comment_url}")
+            metrics.reports.inc("comment")
+        case "cancel":
+            await close_draft(draft_id)
+            await interaction.edit_original_response(content="Bug report cancelled!", view=None)
+            metrics.reports.inc("cancelled")
+        case "regenerate" | "correct":
+            progress = "Regenerating bug report..." if action == "regenerate" else "Correcting bug report..."
+            await interaction.edit_original_response(content=progress, view=None)
+
+            reworked = await rework_draft(draft_id, draft, action, comment)
+
+            if not reworked:
+                await interaction.followup.send(f"Failed to {action} the bug report.", ephemeral=True)
+
+            await storage.unlock_draft(draft_id, {key: draft[key] for key in ["issue", "title", "markdown",
+                                                                              "duplicates"]})
+            await interaction.edit_original_response(content=format_draft(draft), view=make_draft_view(draft))
+
+async def handle_draft_action(interaction: discord.Interaction, action: str, comment: str = "") -> None:
+    await interaction.response.defer()
+
+    if action not in ("regenerate", "correct"):
+        await process_draft_action(interaction, action, comment)
+        return
+
+    # Reworking a draft is compute again, so it waits for a report slot like a new report. The draft is only
+    # locked once the slot is held, so the lock can't run out while queued
+    try:
+        async with state.report_job(interaction.guild.id):
+            await process_draft_action(interaction, action, comment)
+    except Exception as e:
+        _logger.exception(f"Error waiting for a report slot:\n{e}")
+        await interaction.followup.send("There was an error filing the bug report, please contact bot admin.",
+                                        ephemeral=True)
+
+async def process_draft_action(interaction: discord.Interaction, action: str, comment: str) -> None:
+    draft_id = interaction.message.id
+    draft    = await storage.lock_draft(draft_id, _DRAFT_LOCK_S)
+
+    if draft is None:
+        await interaction.followup.send("This bug report is already being processed or has expired.", ephemeral=True)
+        return
+
+    metrics.current_guild.set(draft["guild_id"])
+    common.current_report.set(draft.get("report_id", draft_id))
+
+    try:
+        await run_draft_action(interaction, draft_id, draft, action, comment)
+    except Exception as e:
+        _logger.exception(f"Error handling bug report draft:\n{e}")
+        metrics.reports.inc("error")
+
+        # Leave the draft as it was so the action can be retried
+        await storage.unlock_draft(draft_id)
+        await interaction.edit_original_response(content=format_draft(draft), view=make_draft_view(draft))
+        await interaction.followup.send("There was an error filing the bug report, please contact bot admin.",
+                                        ephemeral=True)
+
+class ScanReview(discord.ui.View):
+    def __init__(self, guild_id: int, drafts: list[scan.Conversation]) -> None:
+        super().__init__(timeout=60 * 30)
+        self.guild_id = guild_id
+        self.drafts   = drafts
+        self.index    = 0
+        self.filed    = []
+        self._lock    = asyncio.Lock()
+
+        self._update_buttons()
+
+    def _add_button(self, label: str, style: discord.ButtonStyle, action) -> None:
+        button = discord.ui.Button(label=label, style=style)
+        index  = self.index
+
+        async def callback(interaction: discord.Interaction) -> None:
+            await self._handle(interaction, index, action)
+
+        button.callback = callback
+        self.add_item(button)
+
+    async def _handle(self, interaction: discord.Interaction, index: int, action) -> None:
+        await interaction.response.defer()
+
+        # Quick repeated presses wait for the first one and are ignored once their draft has been handled
+        async with self._lock:
+            if index == self.index:
+                await action(interaction)
+
+    def _update_buttons(self) -> None:
+        self.clear_items()
+
+        if self.index >= len(self.drafts):
+            return
+
+        draft = self.drafts[self.index]
+
+        self._add_button("File", discord.ButtonStyle.green, self.file)
+
+        if draft.duplicates:
+            self._add_button(f"Add to #{draft.duplicates[0].number}", discord.ButtonStyle.green, self.add_comment)
+
+        self._add_button("Skip", discord.ButtonStyle.grey, self.skip)
+        self._add_button("Stop", discord.ButtonStyle.red, self.finish)
+
+    def get_content(self) -> str:
+        if self.index >= len(self.drafts):
+            return f"Review finished, {len(self.filed)} of {len(self.drafts)} drafts filed." + \
+                   "".join(f"\n{url}" for url in self.filed)
+
+        draft   = self.drafts[self.index]
+        similar = ""
+
+        if draft.similar_to:
+            similar = f"Similar to the draft from {draft.similar_to.get_start().jump_url}\n\n"
+
+        markdown = draft.markdown
+
+        if len(markdown) > _SCAN_DRAFT_MAX_LENGTH:
+            markdown = markdown[:_SCAN_DRAFT_MAX_LENGTH] + "..."
+
+        return f"Draft {self.index + 1} of {len(self.drafts)} from {draft.get_start().jump_url}\n\n{similar}" \
+               f"{format_duplicates(draft.duplicates)}{markdown}"
+
+    async def _show(self, interaction: discord.Interaction) -> None:
+        self._update_buttons()
+
+        # Button presses bring their own interaction, so the review outlives the command's 15 minute token
+        await interaction.edit_original_response(content=self.get_content(), view=self)
+
+        if self.index >= len(self.drafts):
+            self.stop()
+
+    async def file(self, interaction: discord.Interaction) -> None:
+        draft     = self.drafts[self.index]
+        issue_url = await file_issue(self.guild_id, draft.title, draft.markdown, dedupe.get_issue_text(draft.issue))
+
+        self.filed.append(issue_url)
+        metrics.reports.inc("filed")
+
+        self.index += 1
+        await self._show(interaction)
+
+    async def add_comment(self, interaction: discord.Interaction) -> None:
+        config = await state.get_config(self.guild_id)
+        draft  = self.drafts[self.index]
+
+        self.filed.append(await ghclient.add_comment(config.github_repo, draft.duplicates[0].number, draft.markdown))
+        metrics.reports.inc("comment")
+
+        self.index += 1
+        await self._show(interaction)
+
+    async def skip(self, interaction: discord.Interaction) -> None:
+        self.index += 1
+        await self._show(interaction)
+
+    async def finish(self, interaction: discord.Interaction) -> None:
+        self.drafts = self.drafts[:self.index]
+        await self._show(interaction)
+
+    async def on_error(self, interaction: discord.Interaction, error: Exception, item: discord.ui.Item) -> None:
+        _logger.exception(f"Error reviewing scanned bug reports:\n{error}")
+        await interaction.followup.send("There was an error filing the bug report, please contact bot admin.",
+                                        ephemeral=True)
+
+async def prewarm_guild(guild_id: int, semaphore: asyncio.Semaphore) -> None:
+    async with semaphore:
+        try:
+            # Loads the analysis prompts and field names, and mints a GitHub token while verifying the config
+            config = await state.get_config(guild_id)
+            await get_config_error(guild_id, config)
+        except Exception as e:
+            _logger.error(f"Failed to prewarm guild {guild_id}: {e}")
+
+async def prewarm_guilds(configs: dict[int, Config]) -> None:
+    start     = time.perf_counter()
+    semaphore = asyncio.Semaphore(_PREWARM_CONCURRENCY)
+
+    # Guilds that never finished setup have nothing worth warming up
+    guild_ids = [guild_id for guild_id, config in configs.items() if config.github_repo][:_PREWARM_MAX_GUILDS]
+
+    await asyncio.gather(*(prewarm_guild(guild_id, semaphore) for guild_id in guild_ids))
+
+    _logger.info(f"Prewarmed {len(guild_ids)} guilds in {time.perf_counter() - start:.2f}s")
 
 @client.event
 async def on_ready():
+    global _prewarm_task
+
     # await client.tree.sync()
-    state.init()
+    state.init(lease_owner)
+    configs = await state.preload_configs([guild.id for guild in client.guilds])
     _logger.info(f"{client.user} is ready and online!")
 
+    # on_ready fires again after reconnects, the states are still warm then
+    if _prewarm_task is None:
+        _prewarm_task = asyncio.create_task(prewarm_guilds(configs))
+
+# History snapshots refetch messages that changed after they were taken
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    chatproc.note_message_changed(payload.message_id)
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    chatproc.note_message_changed(payload.message_id)
+
+@client.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        chatproc.note_message_changed(message_id)
+
 def extract_message_link_ids(url) -> tuple[int, int, int]:
     match = re.match(r"https://discord.com/channels/(\d+)/(\d+)/(\d+)", url)
 
@@ -250,6 +721,20 @@ def extract_message_link_ids(url) -> tuple[int, int, int]:
 
     return None
 
+def register_gauges() -> None:
+    metrics.register_gauge("bugbot_reports_running", "Reports currently being processed",
+                           lambda: state.get_cache_stats()["active"])
+    metrics.register_gauge("bugbot_reports_queued", "Reports waiting for a free slot",
+                           lambda: state.get_cache_stats()["queued"])
+    metrics.register_gauge("bugbot_guild_states", "Guild states in the cache",
+                           lambda: state.get_cache_stats()["entries"])
+    metrics.register_gauge("bugbot_guild_state_bytes", "Estimated size of the guild state cache",
+                           lambda: state.get_cache_stats()["bytes"])
+    metrics.register_gauge("bugbot_guild_state_evictions", "Guild states evicted from the cache",
+                           lambda: state.get_cache_stats()["evictions"])
+
+register_gauges()
+
 async def get_message_from_link(message_link, wanted_guild_id) -> discord.Message:
     guild_id, channel_id, message_id = extract_message_link_ids(message_link)
 
@@ -260,12 +745,114 @@ async def get_message_from_link(message_link, wanted_guild_id) -> discord.Messag
 
     return await channel.fetch_message(message_id)
 
+async def analyse_issue_with_preview(followup_message: discord.WebhookMessage, analysis_suite: AnalysisSuite,
+                                     combined_history: str, bug_hint: str) -> dict:
+    preview = ProgressMessage(followup_message, "Analysing chat log...")
+
+    try:
+        issue_analysis = await analysis_suite.analyse_issue(combined_history, bug_hint, preview.append)
+    finally:
+        await preview.close()
+
+    return issue_analysis
+
 @client.tree.command(name="setup")
 async def setup(interaction: discord.Interaction):
     setup_modal = Setup()
     await setup_modal.populate(interaction.guild.id)
     await interaction.response.send_modal(setup_modal)
 
+@client.tree.command(name="bugimport")
+async def import_issues(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    config = await state.get_config(interaction.guild.id)
+
+    if not await check_config(interaction, config):
+        return
+
+    try:
+        issues = await ghclient.get_open_issues(config.github_repo)
+        await dedupe.import_issues(config.github_repo, issues)
+    except Exception as e:
+        _logger.exception(f"Error importing issues:\n{e}")
+        await interaction.followup.send("There was an error importing issues, please contact bot admin.",
+                                        ephemeral=True)
+        return
+
+    await interaction.followup.send(f"Imported {len(issues)} open issues for duplicate detection", ephemeral=True)
+
+@client.tree.command(name="stats")
+@app_commands.default_permissions(administrator=True)
+async def stats(interaction: discord.Interaction):
+    await interaction.response.send_message(format_stats(), ephemeral=True)
+
+@client.tree.command(name="bugscan")
+@app_commands.default_permissions(manage_messages=True)
+@app_commands.describe(channel='Channel to scan for bug reports',
+                       since_hours='Scan messages from this many hours ago',
+                       until_hours='Scan messages up to this many hours ago',
+                       bug_hint='Hint with regards to the bugs')
+async def scan_reports(interaction: discord.Interaction, channel: discord.TextChannel,
+                       since_hours: app_commands.Range[int, 1, 24 * 30] = 24,
+                       until_hours: app_commands.Range[int, 0, 24 * 30] = 0, bug_hint: Optional[str] = "None"):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    if not await check_config(interaction, await state.get_config(interaction.guild.id)):
+        return
+
+    if channel.guild.id != interaction.guild.id or until_hours >= since_hours:
+        await interaction.followup.send("Invalid channel or time range!", ephemeral=True)
+        return
+
+    guild_id = interaction.guild.id
+    now      = datetime.datetime.now(datetime.timezone.utc)
+
+    metrics.current_guild.set(guild_id)
+    common.current_report.set(interaction.id)
+
+    followup_message = await interaction.followup.send(f"Scanning #{channel.name}...", ephemeral=True)
+
+    async def on_queue_position(position: int) -> None:
+        if position:
+            await followup_message.edit(content=f"Waiting for other bug reports, position in queue: {position}...")
+
+    pipeline = scan.make_pipeline(guild_id, bug_hint)
+
+    async def show_progress() -> None:
+        while True:
+            await asyncio.sleep(_SCAN_PROGRESS_INTERVAL_S)
+
+            try:
+                await followup_message.edit(content=f"Scanning #{channel.name}... {pipeline.queued} conversations "
+                                                    f"found, {pipeline.processed['analysis']} analysed, "
+                                                    f"{pipeline.processed['draft']} drafted")
+            except discord.HTTPException as e:
+                _logger.warning(f"Failed to update scan progress: {e}")
+
+    try:
+        # The scan takes a report slot, reviewing the drafts afterwards doesn't
+        async with state.report_job(guild_id, on_queue_position):
+            progress = asyncio.create_task(show_progress())
+
+            try:
+                drafts = await scan.scan_channel(pipeline, channel, now - datetime.timedelta(hours=since_hours),
+                                                 now - datetime.timedelta(hours=until_hours))
+            finally:
+                progress.cancel()
+    except Exception as e:
+        await interaction.followup.send("There was an error scanning the channel, please contact bot admin.",
+                                        ephemeral=True)
+        _logger.exception(f"Error scanning channel:\n{e}")
+        return
+
+    if not drafts:
+        await followup_message.edit(content=f"No issues found in {pipeline.queued} conversations in #{channel.name}!")
+        return
+
+    review = ScanReview(guild_id, drafts)
+    await followup_message.edit(content=review.get_content(), view=review)
+
 @client.tree.command(name="bug")
 @app_commands.describe(message_link='Message link to start reading from',
                        bug_hint='Hint with regards to the bug')
@@ -278,6 +865,9 @@ async def new_report(interaction: discord.Integration, message_link: str, bug_hi
     followup = interaction.followup
     guild_id = interaction.guild.id
 
+    metrics.current_guild.set(guild_id)
+    common.current_report.set(interaction.id)
+
     followup_message = None
 
     message = await get_message_from_link(message_link, interaction.guild.id)
@@ -288,53 +878,56 @@ async def new_report(interaction: discord.Integration, message_link: str, bug_hi
 
     followup_message = await followup.send(f"Preparing bug report...", ephemeral=True)
 
-    while await state.get_busy(guild_id):
-        await asyncio.sleep(10)
+    async def on_queue_position(position: int) -> None:
+        if position:
+            await followup_message.edit(content=f"Waiting for other bug reports, position in queue: {position}...")
+        else:
+            await followup_message.edit(content=f"Preparing bug report...")
 
-    await state.set_busy(guild_id, True)
+    queued_at = time.perf_counter()
 
     try:
-        combined_history = await chatproc.get_history(guild_id, message, 50, 3)
-        analysis_suite = await state.get_analysis_suite(guild_id)
+        async with state.report_job(guild_id, on_queue_position) as job:
+            metrics.stage_seconds.observe(time.perf_counter() - queued_at, "queue_wait")
 
-        issue_analysis = await analysis_suite.analyse_issue(combined_history, bug_hint)
+            config = await state.get_config(guild_id)
 
-        if issue_analysis == {}:
-            await followup_message.edit(content=f"No issues found in the chat log!")
-            await state.set_busy(guild_id, False)
-            return
+            with metrics.timed("history"):
+                combined_history = await chatproc.get_history(guild_id, message, 50, 3, config.chat_token_budget)
 
-        issue_title, issue_md = analysis_suite.make_markdown(issue_analysis)
+            analysis_suite = await state.get_analysis_suite(guild_id)
 
-        while True:
-            confirm_view = Confirm()
-
-            await followup_message.edit(content=f"Confirm bug report?\n\n{issue_md}", view=confirm_view)
-
-            await confirm_view.wait()
-            await followup_message.edit(view=None)
-
-            match confirm_view.value:
-                case "confirm":
-                    issue_url = await file_issue(guild_id, issue_title, issue_md)
-                    await followup.send(f"Bug report filed:\n{issue_url}")
-                    break
-                case "regenerate":
-                    await followup_message.edit(content="Regenerating bug report...", view=None)
-                    issue_analysis = await analysis_suite.analyse_issue(combined_history, bug_hint)
-                    issue_title, issue_md = analysis_suite.make_markdown(issue_analysis)
-                case "correct":
-                    await followup_message.edit(content="Correcting bug report...", view=None)
-                    issue_analysis = await analysis_suite.correct_analysis(issue_analysis, confirm_view.comment)
-                    issue_title, issue_md = analysis_suite.make_markdown(issue_analysis)
-                case "cancel":
-                    await followup_message.edit(content="Bug report cancelled!", view=None)
-                    break
+            issue_analysis = await analyse_issue_with_preview(followup_message, analysis_suite, combined_history,
+                                                              bug_hint)
+
+            draft = {"guild_id" : guild_id, "report_id" : interaction.id, "chat_log" : combined_history,
+                     "hint" : bug_hint}
+
+            if not await set_draft_issue(guild_id, analysis_suite, draft, issue_analysis):
+                await followup_message.edit(content=f"No issues found in the chat log!")
+                metrics.reports.inc("no_issue")
+                return
+
+            # Only a process that still holds the slot may publish the draft
+            await job.check()
+            await storage.put_draft(followup_message.id, draft)
+
+        # The slot is free for other reports while this one waits for review. Guilds that opt in generate
+        # alternatives for Regenerate meanwhile, as another job so they count against the guild's reports
+        if config.prefetch_alternatives:
+            candidates = make_candidate_pool(analysis_suite, draft, _REGENERATE_CANDIDATES)
+            _candidate_pools.put(followup_message.id, candidates)
+            asyncio.create_task(prefetch_candidates(guild_id, candidates))
+
+        await followup_message.edit(content=format_draft(draft), view=make_draft_view(draft))
+    except state.LeaseLostError as e:
+        metrics.reports.inc("error")
+        await followup.send("The bug report was interrupted, please try again.", ephemeral=True)
+        _logger.warning(f"Bug report for guild {guild_id} stopped: {e}")
     except Exception as e:
+        metrics.reports.inc("error")
         await followup.send("There was an error filing the bug report, please contact bot admin.", ephemeral=True)
         _logger.exception(f"Error filing bug report:\n{e}")
 
-    await state.set_busy(guild_id, False)
-
 if __name__ == "__main__":
     client.run(os.getenv('DISCORD_TOKEN'))
@@ -0,0 +1,51 @@
+import time
+
+from collections import OrderedDict
+from typing import Any, Hashable
+
+class LRUCache:
+    def __init__(self, max_entries: int, ttl: float = 0) -> None:
+        self._entries     = OrderedDict()
+        self._max_entries = max_entries
+        self._ttl         = ttl
+        self.hits         = 0
+        self.misses       = 0
+        self.evictions    = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _is_expired(self, expires: float) -> bool:
+        return expires != 0 and expires < time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+
+        if entry is None or self._is_expired(entry[1]):
+            if entry is not None:
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self._ttl if self._ttl else 0
+
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        self._entries.clear()
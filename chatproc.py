@@ -1,23 +1,250 @@
+import aiohttp
+import asyncio
+import codecs
+import common
 import datetime
 import discord
-import requests
+import gpt
+import imageproc
+import metrics
+import re
 import state
+import time
 
-from bs4 import BeautifulSoup
+from cache import LRUCache
+from html.parser import HTMLParser
 
-def _get_embed_content_url(url: str) -> str:
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, "html.parser")
+_EMBED_FETCH_TIMEOUT_S  = 5
+_EMBED_MAX_CONNECTIONS  = 16
+_EMBED_HEAD_MAX_BYTES   = 64 * 1024
+_EMBED_CHUNK_SIZE       = 8 * 1024
+_EMBED_CACHE_SIZE       = 2048
+_EMBED_CACHE_TTL_S      = 60 * 60 * 6
 
-    def is_embed_image(meta):
-        return meta.get("property") == "og:image"
+# Pages that are gone for good are cached as having no image, like pages without og:image
+_EMBED_GONE_STATUSES    = (404, 410)
 
-    meta = soup.find(is_embed_image)
+_REPLY_FETCH_CONCURRENCY = 8
 
-    if meta:
-        return meta.get("content")
+# Repeated reports on the same thread reuse the fetched and processed history
+_HISTORY_SNAPSHOT_CACHE_SIZE = 256
+_HISTORY_SNAPSHOT_TTL_S      = 60 * 30
+_CHANGED_MESSAGES_SIZE       = 16384
 
-    return None
+# Messages given to the vision model as context for an image, starting with the one it's attached to
+_IMAGE_CONTEXT_MESSAGES  = 5
+
+# Chat log compaction, only applied when the log doesn't fit the token budget
+_URL_PATTERN             = re.compile(r"https?://([^/\s]+)\S*")
+_CUSTOM_EMOJI_PATTERN    = re.compile(r"<a?(:\w+:)\d+>")
+_MARKUP_PATTERN          = re.compile(r"\*\*|__|~~|\|\|")
+_CODE_BLOCK_PATTERN      = re.compile(r"```(\w*\n)?(.*?)```", re.DOTALL)
+_CODE_BLOCK_KEEP_LINES   = 6
+_DUPLICATE_MIN_LENGTH    = 16
+_REPEATED_LINE           = "<repeated line>"
+
+# Messages are dropped from the least relevant first when compaction isn't enough
+_RELEVANCE_LOW           = 0
+_RELEVANCE_MEDIUM        = 1
+_RELEVANCE_HIGH          = 2
+
+_logger = common.get_logger("ChatProc")
+
+# Sentinel for pages that were fetched but had no og:image
+_NO_EMBED_IMAGE = ""
+
+_http_session         = None
+_embed_url_cache      = LRUCache(_EMBED_CACHE_SIZE, _EMBED_CACHE_TTL_S)
+_embed_url_in_flight  = {}
+_history_snapshots    = LRUCache(_HISTORY_SNAPSHOT_CACHE_SIZE, _HISTORY_SNAPSHOT_TTL_S)
+
+# When messages were last edited or deleted, snapshots older than that refetch them
+_changed_messages     = LRUCache(_CHANGED_MESSAGES_SIZE, _HISTORY_SNAPSHOT_TTL_S)
+
+class _EmbedImageParser(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.image_url = None
+        self.done      = False
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str]]) -> None:
+        if tag == "meta":
+            attrs = dict(attrs)
+
+            if attrs.get("property") == "og:image":
+                self.image_url = attrs.get("content")
+                self.done      = True
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "head":
+            self.done = True
+
+def _get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=_EMBED_MAX_CONNECTIONS,
+                                                                             ttl_dns_cache=300),
+                                              timeout=aiohttp.ClientTimeout(total=_EMBED_FETCH_TIMEOUT_S))
+
+    return _http_session
+
+async def close() -> None:
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+    await imageproc.close()
+
+async def _fetch_embed_content_url(url: str) -> str | None:
+    parser     = _EmbedImageParser()
+    read_bytes = 0
+
+    async with _get_http_session().get(url) as response:
+        if response.status in _EMBED_GONE_STATUSES:
+            return _NO_EMBED_IMAGE
+
+        # Rate limits and server errors may pass, so they aren't remembered
+        if response.status != 200:
+            _logger.warning(f"Error resolving embed image for {url}: HTTP {response.status}")
+            return None
+
+        # Direct links to images don't need any scraping
+        if response.content_type.startswith("image/"):
+            return url
+
+        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="ignore")
+
+        async for chunk in response.content.iter_chunked(_EMBED_CHUNK_SIZE):
+            parser.feed(decoder.decode(chunk))
+            read_bytes += len(chunk)
+
+            if parser.done or read_bytes >= _EMBED_HEAD_MAX_BYTES:
+                break
+
+    return parser.image_url or _NO_EMBED_IMAGE
+
+async def _get_embed_content_url(url: str) -> str:
+    image_url = _embed_url_cache.get(url)
+
+    metrics.record_cache("embed", image_url is not None)
+
+    if image_url is not None:
+        return image_url or None
+
+    # Share a single fetch between concurrent lookups of the same link
+    task = _embed_url_in_flight.get(url)
+
+    if task is None:
+        task = _embed_url_in_flight[url] = asyncio.create_task(_fetch_embed_content_url(url))
+
+        # The task clears itself, its waiters may all be cancelled before it finishes
+        task.add_done_callback(lambda _: _embed_url_in_flight.pop(url, None))
+
+    try:
+        with metrics.timed("embed_resolve"):
+            image_url = await asyncio.shield(task)
+    except (aiohttp.ClientError, asyncio.TimeoutError, LookupError) as e:
+        _logger.error(f"Error resolving embed image for {url}: {e}")
+        return None
+
+    if image_url is not None:
+        _embed_url_cache.put(url, image_url)
+
+    return image_url or None
+
+class _HistoryEntry:
+    def __init__(self, author: str, content: str, extra: str, relevance: int) -> None:
+        self.author    = author
+        self.content   = content
+        self.extra     = extra
+        self.relevance = relevance
+
+    def render(self) -> str:
+        return f"\t{self.author}: {self.content}{self.extra}\n\n"
+
+def _shorten_code_block(match: re.Match) -> str:
+    lines = match.group(2).split("\n")
+
+    if len(lines) <= _CODE_BLOCK_KEEP_LINES * 2:
+        return match.group(0)
+
+    omitted = len(lines) - _CODE_BLOCK_KEEP_LINES * 2
+    lines   = lines[:_CODE_BLOCK_KEEP_LINES] + [f"<{omitted} lines omitted>"] + lines[-_CODE_BLOCK_KEEP_LINES:]
+
+    return "```" + (match.group(1) or "") + "\n".join(lines) + "```"
+
+def _compact_text(text: str, seen_lines: set[str]) -> str:
+    text = _URL_PATTERN.sub(r"<link: \1>", text)
+    text = _CUSTOM_EMOJI_PATTERN.sub(r"\1", text)
+    text = _MARKUP_PATTERN.sub("", text)
+    text = _CODE_BLOCK_PATTERN.sub(_shorten_code_block, text)
+
+    lines = []
+
+    # Pasted logs and copied messages tend to repeat the same long lines
+    for line in text.split("\n"):
+        key = line.strip()
+
+        if len(key) >= _DUPLICATE_MIN_LENGTH:
+            if key in seen_lines:
+                if not lines or lines[-1] != _REPEATED_LINE:
+                    lines.append(_REPEATED_LINE)
+                continue
+
+            seen_lines.add(key)
+
+        lines.append(line)
+
+    return "\n".join(lines)
+
+def _build_chat_log(entries: list[_HistoryEntry], token_budget: int) -> tuple[str, int, int]:
+    parts = [entry.render() for entry in entries]
+
+    if not token_budget:
+        return "".join(parts), 0, 0
+
+    original_tokens = sum(gpt.count_tokens(part) for part in parts)
+
+    if original_tokens <= token_budget:
+        return "".join(parts), original_tokens, 0
+
+    seen_lines = set()
+
+    for entry in entries:
+        entry.content = _compact_text(entry.content, seen_lines)
+
+    parts  = [entry.render() for entry in entries]
+    tokens = [gpt.count_tokens(part) for part in parts]
+    total  = sum(tokens)
+
+    # The first message introduces the issue, so it's always kept. Among the rest,
+    # the least relevant go first and the newest of equally relevant ones before older
+    drop_order = sorted(range(1, len(entries)), key=lambda i: (entries[i].relevance, -i))
+    dropped    = set()
+
+    for i in drop_order:
+        if total <= token_budget:
+            break
+
+        dropped.add(i)
+        total -= tokens[i]
+
+    parts = [part for i, part in enumerate(parts) if i not in dropped]
+
+    if dropped:
+        parts.append(f"\t<{len(dropped)} less relevant messages omitted>\n\n")
+
+    chat_log = "".join(parts)
+
+    # Last resort for a single huge message, cut it down to roughly fit
+    if total > token_budget:
+        chat_log = chat_log[:len(chat_log) * token_budget // total]
+
+    final_tokens = gpt.count_tokens(chat_log)
+
+    return chat_log, final_tokens, original_tokens - final_tokens
 
 async def _get_message_author(guild_id: int, message: discord.Message) -> str:
     if isinstance(message.author, discord.Member):
@@ -28,7 +255,7 @@ async def _get_message_author(guild_id: int, message: discord.Message) -> str:
 
     return message.author.name
 
-def _get_message_images(message: discord.Message, cur_num_images: int, max_images: int) -> list[str]:
+async def _get_message_images(message: discord.Message, cur_num_images: int, max_images: int) -> list[str]:
     image_urls = []
 
     for attachment in message.attachments:
@@ -44,47 +271,241 @@ def _get_message_images(message: discord.Message, cur_num_images: int, max_image
             break
 
         if embed.type == "image":
-            embed_content_url = _get_embed_content_url(embed.url)
+            embed_content_url = await _get_embed_content_url(embed.url)
             if embed_content_url:
                 image_urls.append(embed_content_url)
                 cur_num_images += 1
 
     return image_urls
 
-async def _get_image_description_for_message(guild_id: int, message: discord.Message, image_urls: list[str]) -> str:
-    if not image_urls:
-        return message.content
-
-    message_context = await get_history(guild_id, message, 5, 0)
+async def _get_image_description_for_message(guild_id: int, message_context: list[discord.Message],
+                                             image_urls: list[str]) -> str:
+    context_log    = await format_history(guild_id, message_context, message_context[0].author.name)
     analysis_suite = await state.get_analysis_suite(guild_id)
 
-    image_analysis = await analysis_suite.analyse_images(message_context, image_urls)
+    image_analysis = await analysis_suite.analyse_images(context_log, image_urls)
 
     return f"\n<IMAGES ATTACHED TO THIS MESSAGE: {image_analysis}>"
 
-async def get_history(guild_id: int, message: discord.Message, limit: int, max_images: int) -> str:
-    combined_history = ""
-    image_urls = []
-    image_count = 0
+async def _fetch_message(channel: discord.abc.Messageable, message_id: int,
+                         semaphore: asyncio.Semaphore) -> discord.Message:
+    async with semaphore:
+        return await channel.fetch_message(message_id)
+
+async def _resolve_replies(message_history: list[discord.Message], skip_ids: dict = {}) -> dict[int, discord.Message]:
+    window_messages = {history_message.id: history_message for history_message in message_history}
+    resolved        = {}
+    missing         = {}
+
+    for history_message in message_history:
+        if history_message.id in skip_ids:
+            continue
+
+        if history_message.type != discord.MessageType.reply or not history_message.reference:
+            continue
+
+        msg_ref_id = history_message.reference.message_id
+
+        if msg_ref_id is None or msg_ref_id in resolved or msg_ref_id in missing:
+            continue
+
+        msg_ref = window_messages.get(msg_ref_id)
+
+        if msg_ref is None and isinstance(history_message.reference.resolved, discord.Message):
+            msg_ref = history_message.reference.resolved
+
+        if msg_ref is None:
+            # Client message cache, filled by the gateway
+            msg_ref = history_message._state._get_message(msg_ref_id)
+
+        if msg_ref is None:
+            missing[msg_ref_id] = history_message.channel
+        else:
+            resolved[msg_ref_id] = msg_ref
 
+    if missing:
+        semaphore = asyncio.Semaphore(_REPLY_FETCH_CONCURRENCY)
+        fetched   = await asyncio.gather(*(_fetch_message(channel, msg_ref_id, semaphore)
+                                           for msg_ref_id, channel in missing.items()), return_exceptions=True)
+
+        for msg_ref_id, msg_ref in zip(missing, fetched):
+            if isinstance(msg_ref, discord.Message):
+                resolved[msg_ref_id] = msg_ref
+            else:
+                _logger.warning(f"Failed to fetch replied message {msg_ref_id}: {msg_ref}")
+
+    return resolved
+
+async def fetch_history(message: discord.Message, limit: int) -> list[discord.Message]:
     after = message.created_at - datetime.timedelta(seconds=3)
-    message_history = [history_message async for history_message in message.channel.history(limit=limit, after=after)]
+    return [history_message async for history_message in message.channel.history(limit=limit, after=after)]
+
+async def describe_images(guild_id: int, message_history: list[discord.Message], author_name: str,
+                          max_images: int, known_descriptions: dict[int, str] = {}) -> dict[int, str]:
+    image_messages = []
+    image_count    = 0
+    descriptions   = {}
+
+    # Only the reporter's images are described, each with the few messages that follow it as context
+    for i, history_message in enumerate(message_history):
+        if image_count >= max_images:
+            break
+
+        if history_message.author.name != author_name:
+            continue
+
+        new_image_urls = await _get_message_images(history_message, image_count, max_images)
+
+        if not new_image_urls:
+            continue
+
+        image_count += len(new_image_urls)
+
+        if history_message.id in known_descriptions:
+            descriptions[history_message.id] = known_descriptions[history_message.id]
+        else:
+            image_messages.append((history_message.id, message_history[i:i + _IMAGE_CONTEXT_MESSAGES], new_image_urls))
+
+    described = await asyncio.gather(*(_get_image_description_for_message(guild_id, message_context, image_urls)
+                                       for _, message_context, image_urls in image_messages))
+
+    for (message_id, _, _), description in zip(image_messages, described):
+        descriptions[message_id] = description
+
+    return descriptions
+
+async def _make_history_entry(guild_id: int, history_message: discord.Message, author_name: str,
+                              reply_references: dict[int, discord.Message]) -> _HistoryEntry:
+    message_extra = ""
+    relevance     = _RELEVANCE_LOW
+
+    if history_message.author.name == author_name:
+        relevance = _RELEVANCE_HIGH
+
+    if history_message.type == discord.MessageType.reply and history_message.reference:
+        msg_ref = reply_references.get(history_message.reference.message_id)
+
+        if msg_ref:
+            message_extra += f"\n<REPLYING TO: {await _get_message_author(guild_id, msg_ref)}: {msg_ref.content}>"
+            relevance = max(relevance, _RELEVANCE_MEDIUM)
+
+    message_author = await _get_message_author(guild_id, history_message)
+
+    if message_author != history_message.author.name:
+        relevance = max(relevance, _RELEVANCE_MEDIUM)
+
+    return _HistoryEntry(message_author, history_message.content, message_extra, relevance)
+
+async def format_history(guild_id: int, message_history: list[discord.Message], author_name: str,
+                         token_budget: int = 0, image_descriptions: dict[int, str] = {},
+                         entry_cache: dict[int, _HistoryEntry] = None) -> str:
+    if entry_cache is None:
+        entry_cache = {}
+
+    with metrics.timed("replies"):
+        reply_references = await _resolve_replies(message_history, entry_cache)
+
+    entries = []
 
     for history_message in message_history:
-        message_content = history_message.content
+        entry = entry_cache.get(history_message.id)
+
+        if entry is None:
+            entry = await _make_history_entry(guild_id, history_message, author_name, reply_references)
+            entry_cache[history_message.id] = entry
+
+        # Compaction rewrites the entries, so the cached ones are copied
+        entries.append(_HistoryEntry(entry.author, entry.content,
+                                     image_descriptions.get(history_message.id, "") + entry.extra, entry.relevance))
+
+    chat_log, tokens, saved_tokens = _build_chat_log(entries, token_budget)
+
+    if saved_tokens:
+        _logger.info(f"Chat log from message {message_history[0].id} compacted to {tokens} tokens, "
+                     f"saved {saved_tokens} tokens")
+
+    return chat_log
+
+def note_message_changed(message_id: int) -> None:
+    _changed_messages.put(message_id, time.monotonic())
+
+async def _refetch_message(channel: discord.abc.Messageable, message_id: int,
+                           semaphore: asyncio.Semaphore) -> discord.Message:
+    try:
+        return await _fetch_message(channel, message_id, semaphore)
+    except discord.NotFound:
+        return None
+
+class _HistorySnapshot:
+    def __init__(self) -> None:
+        self.messages           = []
+        self.entries            = {}
+        self.image_descriptions = {}
+        self.updated            = 0
+        self.lock               = asyncio.Lock()
+
+    def _forget(self, message_id: int) -> None:
+        self.entries.pop(message_id, None)
+        self.image_descriptions.pop(message_id, None)
+
+    async def update(self, message: discord.Message, limit: int) -> None:
+        # Taken before fetching, so changes noted meanwhile are picked up next time
+        updated      = time.monotonic()
+        messages     = list(self.messages)
+        changed      = [i for i, history_message in enumerate(messages)
+                        if _changed_messages.get(history_message.id, 0) > self.updated]
+        changed_from = changed[0] if changed else None
+
+        if changed:
+            semaphore = asyncio.Semaphore(_REPLY_FETCH_CONCURRENCY)
+            fetched   = await asyncio.gather(*(_refetch_message(message.channel, messages[i].id, semaphore)
+                                               for i in changed))
+
+            for i, history_message in zip(changed, fetched):
+                self._forget(messages[i].id)
+                messages[i] = history_message
+
+            messages = [history_message for history_message in messages if history_message is not None]
+
+        # The window only grows until it's full, newer messages don't change it after that
+        if len(messages) < limit:
+            if messages:
+                after = discord.Object(messages[-1].id)
+                newer = [history_message async for history_message in
+                         message.channel.history(limit=limit - len(messages), after=after)]
+            else:
+                newer = await fetch_history(message, limit)
+
+            if newer and changed_from is None:
+                changed_from = len(messages)
+
+            messages += newer
+
+        # Images are described with the messages that follow them as context
+        if changed_from is not None:
+            for history_message in messages[max(0, changed_from - _IMAGE_CONTEXT_MESSAGES + 1):]:
+                self.image_descriptions.pop(history_message.id, None)
+
+        self.messages = messages
+        self.updated  = updated
+
+async def get_history(guild_id: int, message: discord.Message, limit: int, max_images: int,
+                      token_budget: int = 0) -> str:
+    key      = (message.channel.id, message.id, limit, max_images)
+    snapshot = _history_snapshots.get(key)
+
+    metrics.record_cache("history", snapshot is not None)
 
-        if history_message.author.name == message.author.name and image_count < max_images:
-            new_image_urls = _get_message_images(history_message, image_count, max_images)
-            if new_image_urls:
-                image_urls += new_image_urls
-                image_count += len(new_image_urls)
-                message_content += await _get_image_description_for_message(guild_id, history_message, new_image_urls)
+    if snapshot is None:
+        snapshot = _HistorySnapshot()
+        _history_snapshots.put(key, snapshot)
 
-        if history_message.type == discord.MessageType.reply:
-            msg_ref_id       = history_message.reference.message_id
-            msg_ref          = await history_message.channel.fetch_message(msg_ref_id)
-            message_content += f"\n<REPLYING TO: {await _get_message_author(guild_id, msg_ref)}: {msg_ref.content}>"
+    # Reports on the same thread take turns, so the later ones reuse what the first one fetched
+    async with snapshot.lock:
+        await snapshot.update(message, limit)
 
-        combined_history += f"\t{await _get_message_author(guild_id, history_message)}: {message_content}\n\n"
+        snapshot.image_descriptions = await describe_images(guild_id, snapshot.messages, message.author.name,
+                                                            max_images, snapshot.image_descriptions)
 
-    return combined_history
\ No newline at end of file
+        return await format_history(guild_id, snapshot.messages, message.author.name, token_budget,
+                                    snapshot.image_descriptions, snapshot.entries)
@@ -1,7 +1,157 @@
+import atexit
+import contextvars
+import datetime
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import time
 
 LOG_FORMAT = "[%(asctime)s] [%(levelname)s] [%(name)s]: %(message)s"
 DIR_PROMPTS = "prompts"
 
+_LOG_MAX_BYTES             = 50 * 1024 * 1024
+_LOG_BACKUP_COUNT          = 10
+
+# Identical records past the burst are dropped for the rest of the window and counted instead
+_LOG_DUPLICATE_WINDOW_S    = 60
+_LOG_DUPLICATE_BURST       = 5
+_LOG_DUPLICATE_MAX_ENTRIES = 4096
+
+# Correlation ids, inherited by tasks created while they are set
+current_guild  = contextvars.ContextVar("current_guild", default=0)
+current_report = contextvars.ContextVar("current_report", default=None)
+
+_log_listener    = None
+_console_handler = None
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The writer thread is in the same process, so formatting is left to it entirely
+        record.guild  = current_guild.get()
+        record.report = current_report.get()
+
+        return record
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time"    : datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level"   : record.levelname,
+            "logger"  : record.name,
+            "message" : record.getMessage()
+        }
+
+        if getattr(record, "guild", 0):
+            entry["guild"] = record.guild
+
+        if getattr(record, "report", None) is not None:
+            entry["report"] = record.report
+
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+class _LogWriter(logging.handlers.QueueListener):
+    def __init__(self, log_queue: queue.SimpleQueue, *handlers: logging.Handler) -> None:
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self._duplicates = {}
+
+    def _make_summary(self, key: tuple) -> logging.LogRecord:
+        _, count, record = self._duplicates[key]
+        suppressed       = count - _LOG_DUPLICATE_BURST
+
+        if suppressed <= 0:
+            return None
+
+        return logging.makeLogRecord({**record.__dict__,
+                                      "msg"        : f"{suppressed} duplicates suppressed: {record.getMessage()}",
+                                      "args"       : None,
+                                      "exc_info"   : None,
+                                      "exc_text"   : None,
+                                      "created"    : time.time(),
+                                      "suppressed" : suppressed})
+
+    def _is_duplicate(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        key = (record.name, record.levelno, record.getMessage())
+
+        if key in self._duplicates and now - self._duplicates[key][0] >= _LOG_DUPLICATE_WINDOW_S:
+            summary = self._make_summary(key)
+            del self._duplicates[key]
+
+            if summary:
+                super().handle(summary)
+
+        if key not in self._duplicates:
+            if len(self._duplicates) >= _LOG_DUPLICATE_MAX_ENTRIES:
+                self._flush_duplicates()
+
+            self._duplicates[key] = [now, 0, record]
+
+        self._duplicates[key][1] += 1
+
+        return self._duplicates[key][1] > _LOG_DUPLICATE_BURST
+
+    def _flush_duplicates(self) -> None:
+        for key in self._duplicates:
+            summary = self._make_summary(key)
+
+            if summary:
+                super().handle(summary)
+
+        self._duplicates.clear()
+
+    def handle(self, record: logging.LogRecord) -> None:
+        if not self._is_duplicate(record):
+            super().handle(record)
+
+    def stop(self) -> None:
+        super().stop()
+        self._flush_duplicates()
+
+def init_logging(log_dir: str, console_level: int = logging.INFO) -> None:
+    global _log_listener, _console_handler
+
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Processes of a sharded deployment each write their own file
+    log_path = f"{log_dir}/{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl"
+
+    file_handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=_LOG_MAX_BYTES,
+                                                        backupCount=_LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(_JsonFormatter())
+
+    _console_handler = logging.StreamHandler()
+    _console_handler.setLevel(console_level)
+    _console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # Callers only put records on the queue, all formatting and I/O happens on the writer thread
+    log_queue     = queue.SimpleQueue()
+    _log_listener = _LogWriter(log_queue, file_handler, _console_handler)
+    _log_listener.start()
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(_QueueHandler(log_queue))
+
+    atexit.register(stop_logging)
+
+def set_console_level(level: int) -> None:
+    _console_handler.setLevel(level)
+
+def stop_logging() -> None:
+    global _log_listener
+
+    if _log_listener:
+        _log_listener.stop()
+        _log_listener = None
+
 def get_logger(name: str) -> logging.Logger:
     return logging.getLogger(name)
@@ -0,0 +1,111 @@
+import common
+import hashlib
+import re
+import storage
+
+# MinHash signature split into LSH bands, two rows per band catches most pairs from ~30% similarity
+_NUM_BANDS          = 32
+_ROWS_PER_BAND      = 2
+_NUM_HASHES         = _NUM_BANDS * _ROWS_PER_BAND
+
+_MIN_SIMILARITY     = 0.35
+_MAX_DUPLICATES     = 3
+
+_MERSENNE_PRIME     = (1 << 61) - 1
+_MAX_HASH           = (1 << 32) - 1
+
+_WORD_PATTERN       = re.compile(r"[a-z0-9]+")
+
+# Reports are short and paraphrased, so words are compared as a set without the filler
+_STOP_WORDS         = {"a", "an", "and", "are", "as", "at", "be", "but", "by", "do", "does", "for", "from", "has",
+                       "have", "i", "in", "is", "it", "its", "me", "my", "of", "on", "or", "so", "that", "the",
+                       "then", "there", "this", "to", "was", "when", "while", "with"}
+
+_ISSUE_URL_PATTERN  = re.compile(r"/issues/(\d+)$")
+
+_logger = common.get_logger("Dedupe")
+
+def _make_permutations() -> list[tuple[int, int]]:
+    permutations = []
+
+    for i in range(_NUM_HASHES):
+        seed = hashlib.sha256(f"minhash-{i}".encode()).digest()
+        permutations.append((int.from_bytes(seed[:8], "little") % _MERSENNE_PRIME | 1,
+                             int.from_bytes(seed[8:16], "little") % _MERSENNE_PRIME))
+
+    return permutations
+
+_permutations = _make_permutations()
+
+class Duplicate:
+    def __init__(self, number: int, title: str, url: str, similarity: float) -> None:
+        self.number     = number
+        self.title      = title
+        self.url        = url
+        self.similarity = similarity
+
+def get_issue_text(issue: dict) -> str:
+    return issue.get("title", "") + "\n" + issue.get("description", "")
+
+def _get_shingles(text: str) -> set[int]:
+    words = set(_WORD_PATTERN.findall(text.lower())) - _STOP_WORDS
+
+    if not words:
+        words = {""}
+
+    return {int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), "little") for word in words}
+
+def get_signature(text: str) -> list[int]:
+    shingles = _get_shingles(text)
+
+    return [min(((a * shingle + b) % _MERSENNE_PRIME) & _MAX_HASH for shingle in shingles)
+            for a, b in _permutations]
+
+def _get_bands(signature: list[int]) -> list[str]:
+    bands = []
+
+    for band in range(_NUM_BANDS):
+        rows = signature[band * _ROWS_PER_BAND:(band + 1) * _ROWS_PER_BAND]
+        bands.append(f"{band}:" + "-".join(map(str, rows)))
+
+    return bands
+
+def _get_similarity(signature_a: list[int], signature_b: list[int]) -> float:
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / _NUM_HASHES
+
+def is_similar(signature_a: list[int], signature_b: list[int]) -> bool:
+    return _get_similarity(signature_a, signature_b) >= _MIN_SIMILARITY
+
+def get_issue_number(issue_url: str) -> int:
+    match = _ISSUE_URL_PATTERN.search(issue_url)
+    return int(match.group(1)) if match else 0
+
+async def add_issue(repo: str, number: int, title: str, url: str, text: str) -> None:
+    signature = get_signature(text)
+
+    await storage.put_indexed_issue(repo, number, {
+        "title"     : title,
+        "url"       : url,
+        "signature" : signature,
+        "bands"     : _get_bands(signature)
+    })
+
+async def find_duplicates(repo: str, text: str) -> list[Duplicate]:
+    signature  = get_signature(text)
+    duplicates = []
+
+    for issue in await storage.find_indexed_issues(repo, _get_bands(signature)):
+        similarity = _get_similarity(signature, issue["signature"])
+
+        if similarity >= _MIN_SIMILARITY:
+            duplicates.append(Duplicate(issue["number"], issue["title"], issue["url"], similarity))
+
+    duplicates.sort(key=lambda duplicate: duplicate.similarity, reverse=True)
+
+    return duplicates[:_MAX_DUPLICATES]
+
+async def import_issues(repo: str, issues: list[tuple[int, str, str, str]]) -> None:
+    for number, title, body, url in issues:
+        await add_issue(repo, number, title, url, title + "\n" + body)
+
+    _logger.info(f"Imported {len(issues)} issues from {repo}")
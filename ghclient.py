@@ -0,0 +1,121 @@
+import asyncio
+import common
+import time
+
+from github import Auth
+from github import Github
+from github import GithubException
+from github import GithubIntegration
+from github.Repository import Repository
+
+# Mint a new installation token this long before the current one expires
+_TOKEN_REFRESH_MARGIN_S = 60 * 5
+
+_logger = common.get_logger("GitHub")
+
+_integration = None
+_clients     = {}
+
+class _RepoClient:
+    def __init__(self, repo_name: str) -> None:
+        self._repo_name       = repo_name
+        self._installation_id = None
+        self._github          = None
+        self._repo            = None
+        self._expires         = 0
+        self._lock            = asyncio.Lock()
+
+    def _refresh(self) -> None:
+        owner, name = self._repo_name.split("/")
+
+        if self._installation_id is None:
+            self._installation_id = _integration.get_repo_installation(owner, name).id
+
+        token = _integration.get_access_token(self._installation_id)
+
+        # Calls in worker threads may still be using the old client, it is left for them to drop
+        self._github  = Github(auth=Auth.Token(token.token))
+        self._repo    = self._github.get_repo(self._repo_name, lazy=True)
+        self._expires = token.expires_at.timestamp()
+
+        _logger.debug(f"Minted installation token for {self._repo_name}")
+
+    async def _get_current(self) -> tuple[Github, Repository]:
+        async with self._lock:
+            if self._github is None or time.time() > self._expires - _TOKEN_REFRESH_MARGIN_S:
+                await asyncio.to_thread(self._refresh)
+
+            return self._github, self._repo
+
+    async def get_github(self) -> Github:
+        github, _ = await self._get_current()
+        return github
+
+    async def get_repo(self) -> Repository:
+        _, repo = await self._get_current()
+        return repo
+
+    def close(self) -> None:
+        if self._github:
+            self._github.close()
+
+def init(app_id: str, key_path: str) -> None:
+    global _integration
+
+    with open(key_path, "r") as file:
+        app_key = file.read()
+
+    _integration = GithubIntegration(auth=Auth.AppAuth(app_id, app_key))
+
+def _get_client(repo_name: str) -> _RepoClient:
+    if repo_name not in _clients:
+        _clients[repo_name] = _RepoClient(repo_name)
+
+    return _clients[repo_name]
+
+def _drop_client(repo_name: str) -> None:
+    client = _clients.pop(repo_name, None)
+
+    if client:
+        client.close()
+
+async def get_repo_full_name(repo_name: str) -> str:
+    try:
+        github = await _get_client(repo_name).get_github()
+        repo   = await asyncio.to_thread(github.get_repo, repo_name)
+    except Exception:
+        # Don't keep clients around for repositories that can't be opened
+        _drop_client(repo_name)
+        raise
+
+    return repo.full_name
+
+async def create_issue(repo_name: str, title: str, body: str, labels: list[str] = []) -> str:
+    repo = await _get_client(repo_name).get_repo()
+
+    try:
+        issue = await asyncio.to_thread(repo.create_issue, title=title, body=body, labels=labels)
+    except GithubException as e:
+        # App may have been uninstalled or lost access, start over on the next call
+        if e.status in (401, 403, 404):
+            _drop_client(repo_name)
+
+        raise
+
+    return issue.html_url
+
+async def add_comment(repo_name: str, number: int, body: str) -> str:
+    repo = await _get_client(repo_name).get_repo()
+
+    issue   = await asyncio.to_thread(repo.get_issue, number)
+    comment = await asyncio.to_thread(issue.create_comment, body)
+
+    return comment.html_url
+
+def _list_open_issues(repo: Repository) -> list[tuple[int, str, str, str]]:
+    return [(issue.number, issue.title, issue.body or "", issue.html_url)
+            for issue in repo.get_issues(state="open") if issue.pull_request is None]
+
+async def get_open_issues(repo_name: str) -> list[tuple[int, str, str, str]]:
+    repo = await _get_client(repo_name).get_repo()
+    return await asyncio.to_thread(_list_open_issues, repo)
@@ -1,35 +1,282 @@
+import asyncio
 import common
+import hashlib
+import httpx
+import imageproc
 import json
+import metrics
+import openai
 import state
+import storage
+import template
+import time
 
-from openai import OpenAI
+from openai import AsyncOpenAI
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+# Shared HTTP connection pool for all OpenAI requests
+_MAX_CONNECTIONS     = 64
+_MAX_KEEPALIVE       = 32
+_REQUEST_TIMEOUT_S   = 120
+
+# Failing models are routed around, so the client itself only retries once
+_MAX_RETRIES         = 1
+
+_MAX_TOKENS          = 4096
+
+# Rough token cost of a single image at high and low detail
+_IMAGE_TOKENS        = 765
+_IMAGE_TOKENS_LOW    = 85
+
+# Per-model limits: (concurrent requests, requests per minute, tokens per minute)
+_MODEL_LIMITS = {
+    "gpt-4-turbo-preview"    : (8,  500,  150000),
+    "gpt-4-vision-preview"   : (4,  100,  40000),
+    "gpt-3.5-turbo"          : (16, 3500, 160000),
+    "gpt-4o-2024-08-06"      : (8,  500,  300000),
+    "gpt-4o-mini-2024-07-18" : (16, 500,  200000),
+}
+
+_DEFAULT_MODEL_LIMITS = (4, 500, 40000)
+
+# Models per task from cheapest to most capable, with the largest input each is trusted with. The cheapest one
+# trusted with the input is picked, then cheaper ones are tried while it's over the guild's budget
+_ROUTES = {
+    "analysis"    : [("gpt-4o-mini-2024-07-18", 1500), ("gpt-4o-2024-08-06", 12000), ("gpt-4-turbo-preview", 120000)],
+    "correct"     : [("gpt-4o-2024-08-06", 12000), ("gpt-4-turbo-preview", 120000)],
+    "format_json" : [("gpt-3.5-turbo", 8000), ("gpt-4o-mini-2024-07-18", 120000)],
+    "fix_json"    : [("gpt-3.5-turbo", 8000), ("gpt-4o-2024-08-06", 120000)],
+    "images"      : [("gpt-4o-2024-08-06", 120000), ("gpt-4-vision-preview", 120000)],
+    "structured"  : [("gpt-4o-mini-2024-07-18", 1500), ("gpt-4o-2024-08-06", 120000)],
+}
+
+_MODEL_CONTEXT_TOKENS   = {"gpt-3.5-turbo": 16385}
+_DEFAULT_CONTEXT_TOKENS = 128000
+
+# Rough completion length used to estimate the cost of a request before making it
+_EXPECTED_COMPLETION_TOKENS = 800
+
+# Latency budgets are checked against the observed median once a model has enough samples for a task
+_MIN_LATENCY_SAMPLES = 5
+
+# Timeouts and overload move a request to another model, and keep new requests away for a while
+_FALLBACK_ERRORS     = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+_FALLBACK_COOLDOWN_S = 30
+
+# Set when the encoding couldn't be loaded, so it isn't attempted again on every count
+_NO_ENCODING   = object()
 
 _openai_client = None
+_encoding      = None
+_cooldowns     = {}
 
 _logger = common.get_logger("GPT")
 
-_prompt_fix_json = ""
+class _TokenBucket:
+    def __init__(self, per_minute: int) -> None:
+        self._capacity = float(per_minute)
+        self._tokens   = float(per_minute)
+        self._rate     = per_minute / 60
+        self._updated  = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens  = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def get_delay(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self._capacity)
+
+        if self._tokens >= amount:
+            return 0
+
+        return (amount - self._tokens) / self._rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self._tokens -= min(amount, self._capacity)
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self._tokens = min(self._capacity, self._tokens + amount)
+
+class _ModelLimiter:
+    def __init__(self, concurrency: int, requests_per_minute: int, tokens_per_minute: int) -> None:
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock      = asyncio.Lock()
+        self._requests  = _TokenBucket(requests_per_minute)
+        self._tokens    = _TokenBucket(tokens_per_minute)
+
+    async def acquire(self, tokens: int) -> None:
+        await self._semaphore.acquire()
+
+        try:
+            # Serialize bucket waits so requests are admitted in arrival order
+            async with self._lock:
+                while True:
+                    delay = max(self._requests.get_delay(1), self._tokens.get_delay(tokens))
+
+                    if delay <= 0:
+                        break
+
+                    await asyncio.sleep(delay)
+
+                self._requests.take(1)
+                self._tokens.take(tokens)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self, reserved_tokens: int, used_tokens: int) -> None:
+        if used_tokens < reserved_tokens:
+            self._tokens.give(reserved_tokens - used_tokens)
+
+        self._semaphore.release()
+
+_limiters = {}
+
+def _get_limiter(model: str) -> _ModelLimiter:
+    if model not in _limiters:
+        _limiters[model] = _ModelLimiter(*_MODEL_LIMITS.get(model, _DEFAULT_MODEL_LIMITS))
 
-with open(f"prompts/fix_json.txt", "r") as file:
-    _prompt_fix_json = file.read()
+    return _limiters[model]
+
+class Budget:
+    def __init__(self, max_cost: float = 0, max_latency: float = 0) -> None:
+        self.max_cost    = max_cost
+        self.max_latency = max_latency
+
+    def allows(self, task: str, model: str, input_tokens: int) -> bool:
+        if self.max_cost and metrics.estimate_cost(model, input_tokens, _EXPECTED_COMPLETION_TOKENS) > self.max_cost:
+            return False
+
+        if self.max_latency and metrics.llm_task_seconds.get_count(task, model) >= _MIN_LATENCY_SAMPLES:
+            return metrics.llm_task_seconds.get_quantile(0.5, task, model) <= self.max_latency
+
+        return True
+
+_NO_BUDGET = Budget()
+
+def _fits_context(model: str, input_tokens: int) -> bool:
+    return input_tokens + _MAX_TOKENS <= _MODEL_CONTEXT_TOKENS.get(model, _DEFAULT_CONTEXT_TOKENS)
+
+def _route(task: str, input_tokens: int, budget: Budget, tried: list[str]) -> tuple[str, str]:
+    candidates = [(model, max_input) for model, max_input in _ROUTES[task]
+                  if model not in tried and _fits_context(model, input_tokens)]
+
+    # Models that failed recently are only used when nothing else is left
+    available = [candidate for candidate in candidates if _cooldowns.get(candidate[0], 0) < time.monotonic()]
+    reason    = "fallback" if tried else "size"
+
+    if not available:
+        available = candidates
+        reason    = "cooldown"
+
+    # Too large for every model, the most capable one gets to reject it
+    if not available and not tried:
+        available = _ROUTES[task][-1:]
+        reason    = "size"
+
+    if not available:
+        return None, None
+
+    index = next((i for i, (_, max_input) in enumerate(available) if input_tokens <= max_input), len(available) - 1)
+
+    while index > 0 and not budget.allows(task, available[index][0], input_tokens):
+        index -= 1
+        reason = "budget"
+
+    return available[index][0], reason
+
+async def _request_routed(task: str, input_tokens: int, budget: Budget,
+                          make_request: Callable[[str], Awaitable]) -> Any:
+    tried = []
+
+    while True:
+        model, reason = _route(task, input_tokens, budget, tried)
+
+        metrics.llm_routes.inc(task, model, reason)
+        _logger.debug(f"Routed {task} with {input_tokens} input tokens to {model} ({reason})")
+
+        try:
+            return await make_request(model)
+        except _FALLBACK_ERRORS as e:
+            _cooldowns[model] = time.monotonic() + _FALLBACK_COOLDOWN_S
+            tried.append(model)
+
+            metrics.llm_fallbacks.inc(task, model, type(e).__name__)
+
+            if _route(task, input_tokens, budget, tried)[0] is None:
+                raise
+
+            _logger.warning(f"{model} failed for {task}, falling back to another model: {e}")
 
 def init(api_key: str) -> None:
     global _openai_client
-    _openai_client = OpenAI(api_key=api_key)
+
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=_MAX_CONNECTIONS,
+                                                        max_keepalive_connections=_MAX_KEEPALIVE),
+                                    timeout=_REQUEST_TIMEOUT_S)
+
+    _openai_client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=_MAX_RETRIES)
 
 def _make_prompt_fix_json(json_text: str, json_error: str) -> str:
-    prompt = _prompt_fix_json
-    prompt = prompt.replace("@json@", json_text)
-    prompt = prompt.replace("@error@", json_error)
+    return template.load("fix_json").render(json=json_text, error=json_error)
+
+def _make_cache_key(kind: str, task: str, system: str, prompt: str, images: list[str | dict] = [],
+                    temperature = 0.1) -> str:
+    key = hashlib.sha256()
+
+    # Keyed by task rather than model, so results stay cached when the routing changes
+    for part in [kind, task, str(temperature), system, prompt, *map(imageproc.get_image_identity, images)]:
+        key.update(part.encode())
+        key.update(b"\0")
 
-    return prompt
+    return key.hexdigest()
+
+async def _get_cached(key: str) -> str | dict | None:
+    try:
+        return await storage.get_llm_result(key)
+    except Exception as e:
+        _logger.error(f"LLM cache lookup failed: {e}")
+        return None
 
-def request(system: str, prompt: str, images: list[str] = [], temperature = 0.1,
-            model = "gpt-4-turbo-preview", json: bool = False) -> str:
+async def _put_cached(key: str, result: str | dict, ttl: int) -> None:
+    try:
+        await storage.put_llm_result(key, result, ttl)
+    except Exception as e:
+        _logger.error(f"LLM cache store failed: {e}")
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def load_encoding() -> None:
+    global _encoding
+
+    # tiktoken is slow to import and loads its vocabulary from disk or the network, so it's done once on demand
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _logger.error(f"Failed to load token encoding, falling back to estimates: {e}")
+            _encoding = _NO_ENCODING
+
+def count_tokens(text: str) -> int:
+    load_encoding()
+
+    if _encoding is _NO_ENCODING:
+        return estimate_tokens(text)
+
+    return len(_encoding.encode(text, disallowed_special=()))
+
+def _make_messages(system: str, prompt: str, images: list[str | dict]) -> list[dict]:
     image_urls = []
 
+    # Images are either plain URLs or prepared image_url objects with a detail level
     for image in images:
-        image_urls.append({"type": "image_url", "image_url": { "url": image }})
+        image_urls.append({"type": "image_url", "image_url": image if isinstance(image, dict) else { "url": image }})
 
     messages = [
         {"role": "system", "content": system},
@@ -40,25 +287,150 @@ def request(system: str, prompt: str, images: list[str] = [], temperature = 0.1,
 
     messages[1]["content"].extend(image_urls)
 
-    if json:
-        completion = _openai_client.chat.completions.create(
+    return messages
+
+def _record_completion(task: str, model: str, completion, start: float, reserved_tokens: int) -> int:
+    metrics.llm_request_seconds.observe(time.perf_counter() - start, model)
+    metrics.llm_task_seconds.observe(time.perf_counter() - start, task, model)
+
+    if not completion.usage:
+        return reserved_tokens
+
+    metrics.record_llm_usage(model, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+
+    return completion.usage.total_tokens
+
+def _get_image_tokens(image: str | dict) -> int:
+    if isinstance(image, dict) and image.get("detail") == "low":
+        return _IMAGE_TOKENS_LOW
+
+    return _IMAGE_TOKENS
+
+def _get_reserved_tokens(system: str, prompt: str, images: list[str | dict]) -> int:
+    image_tokens = sum(map(_get_image_tokens, images))
+    return estimate_tokens(system) + estimate_tokens(prompt) + image_tokens + _MAX_TOKENS
+
+async def _complete(task: str, model: str, messages: list[dict], reserved_tokens: int, temperature: float,
+                    **extra_args):
+    used_tokens = reserved_tokens
+
+    limiter = _get_limiter(model)
+    await limiter.acquire(reserved_tokens)
+
+    try:
+        start = time.perf_counter()
+
+        completion = await _openai_client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
-            response_format={"type": "json_object"},
-            max_tokens=4096
+            max_tokens=_MAX_TOKENS,
+            **extra_args
         )
-    else:
-        completion = _openai_client.chat.completions.create(
+
+        used_tokens = _record_completion(task, model, completion, start, used_tokens)
+    finally:
+        limiter.release(reserved_tokens, used_tokens)
+
+    return completion
+
+async def request(system: str, prompt: str, images: list[str | dict] = [], temperature = 0.1,
+                  task = "analysis", json: bool = False, cache_ttl: int = 0, budget: Budget = _NO_BUDGET) -> str:
+    cache_key = None
+
+    if cache_ttl:
+        cache_key = _make_cache_key("json" if json else "text", task, system, prompt, images, temperature)
+        cached    = await _get_cached(cache_key)
+
+        metrics.record_cache("llm", cached is not None)
+
+        if cached is not None:
+            _logger.debug(f"LLM cache hit for {task}")
+            return cached
+
+    messages   = _make_messages(system, prompt, images)
+    extra_args = {}
+
+    if json:
+        extra_args["response_format"] = {"type": "json_object"}
+
+    reserved_tokens = _get_reserved_tokens(system, prompt, images)
+
+    completion = await _request_routed(task, reserved_tokens - _MAX_TOKENS, budget,
+                                       lambda model: _complete(task, model, messages, reserved_tokens, temperature,
+                                                               **extra_args))
+
+    response_text = completion.choices[0].message.content
+
+    if cache_key and response_text:
+        await _put_cached(cache_key, response_text, cache_ttl)
+
+    return response_text
+
+async def request_structured(system: str, prompt: str, schema: dict, temperature = 0.1,
+                             budget: Budget = _NO_BUDGET) -> dict:
+    messages        = _make_messages(system, prompt, [])
+    reserved_tokens = _get_reserved_tokens(system, prompt, [])
+    response_format = {"type": "json_schema", "json_schema": schema}
+
+    completion = await _request_routed("structured", reserved_tokens - _MAX_TOKENS, budget,
+                                       lambda model: _complete("structured", model, messages, reserved_tokens,
+                                                               temperature, response_format=response_format))
+
+    # Output is constrained to the schema, so only a refusal or truncation can fail to parse
+    try:
+        return json.loads(completion.choices[0].message.content)
+    except Exception as e:
+        _logger.error(f"Structured output parse error: {e}")
+        return {}
+
+async def _open_stream(model: str, messages: list[dict], reserved_tokens: int,
+                       temperature: float) -> tuple[str, AsyncIterator, float]:
+    limiter = _get_limiter(model)
+    await limiter.acquire(reserved_tokens)
+
+    try:
+        start = time.perf_counter()
+
+        stream = await _openai_client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
-            max_tokens=4096
+            max_tokens=_MAX_TOKENS,
+            stream=True
         )
+    except BaseException:
+        limiter.release(reserved_tokens, reserved_tokens - _MAX_TOKENS)
+        raise
+
+    return model, stream, start
 
-    return completion.choices[0].message.content
+async def request_stream(system: str, prompt: str, images: list[str | dict] = [], temperature = 0.1,
+                         task = "analysis", budget: Budget = _NO_BUDGET) -> AsyncIterator[str]:
+    messages        = _make_messages(system, prompt, images)
+    reserved_tokens = _get_reserved_tokens(system, prompt, images)
+    prompt_tokens   = reserved_tokens - _MAX_TOKENS
+    used_tokens     = prompt_tokens
+
+    # Only opening the stream can fall back to another model, once text has been passed on it has to finish
+    model, stream, start = await _request_routed(task, prompt_tokens, budget,
+                                                 lambda model: _open_stream(model, messages, reserved_tokens,
+                                                                            temperature))
+
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                # Streamed responses don't report usage, count the completion locally
+                used_tokens += estimate_tokens(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
 
-def _get_response_json(text: str, allow_fix = True) -> dict:
+        metrics.llm_request_seconds.observe(time.perf_counter() - start, model)
+        metrics.llm_task_seconds.observe(time.perf_counter() - start, task, model)
+        metrics.record_llm_usage(model, prompt_tokens, used_tokens - prompt_tokens)
+    finally:
+        _get_limiter(model).release(reserved_tokens, used_tokens)
+
+async def _get_response_json(text: str, allow_fix = True) -> dict:
     json_data = {}
 
     try:
@@ -69,16 +441,33 @@ def _get_response_json(text: str, allow_fix = True) -> dict:
         if allow_fix:
             # Attempt to fix JSON
             prompt = _make_prompt_fix_json(text, str(e))
-            response_text = request("", prompt=prompt, images=[])
-            json_data = _get_response_json(response_text, allow_fix=False)
+            response_text = await request("", prompt=prompt, images=[], task="fix_json")
+            json_data = await _get_response_json(response_text, allow_fix=False)
 
             if json_data == {}:
                 _logger.error("Failed to fix JSON")
 
     return json_data
 
-def request_json(system: str, prompt: str, model = "gpt-3.5-turbo") -> dict:
-    response_text = request(system, prompt, [], 0.1, model=model, json=True)
-    response_json = _get_response_json(response_text)
+async def request_json(system: str, prompt: str, task = "format_json", cache_ttl: int = 0,
+                       budget: Budget = _NO_BUDGET) -> dict:
+    cache_key = None
+
+    # Cache the parsed result so a response that needed fixing isn't fixed again
+    if cache_ttl:
+        cache_key = _make_cache_key("parsed_json", task, system, prompt)
+        cached    = await _get_cached(cache_key)
+
+        metrics.record_cache("llm", cached is not None)
+
+        if cached is not None:
+            _logger.debug(f"LLM cache hit for {task}")
+            return cached
+
+    response_text = await request(system, prompt, [], 0.1, task=task, json=True, budget=budget)
+    response_json = await _get_response_json(response_text)
+
+    if cache_key and response_json != {}:
+        await _put_cached(cache_key, response_json, cache_ttl)
 
     return response_json
@@ -0,0 +1,289 @@
+import aiohttp
+import asyncio
+import base64
+import common
+import hashlib
+import io
+import metrics
+import os
+import tempfile
+import urllib.parse
+
+from collections import OrderedDict
+from PIL import Image
+
+DIR_IMAGE_CACHE = "cache/images"
+
+_DOWNLOAD_TIMEOUT_S     = 15
+_DOWNLOAD_MAX_BYTES     = 20 * 1024 * 1024
+_MAX_CONNECTIONS        = 16
+
+# Disk cache of downscaled images, least recently used files are removed first
+_CACHE_MAX_BYTES        = 512 * 1024 * 1024
+
+# The vision model fits high detail images into 2048x2048 and then scales the short side to 768
+_MAX_LONG_SIDE          = 2048
+_MAX_SHORT_SIDE         = 768
+
+# Images that fit into a single 512x512 tile lose nothing at low detail
+_LOW_DETAIL_SIDE        = 512
+
+_JPEG_QUALITY           = 85
+
+# Images whose perceptual hashes differ in fewer bits are considered duplicates
+_DUPLICATE_MAX_DISTANCE = 6
+
+# Discord CDN links carry expiring signatures in the query, the path identifies the attachment
+_DISCORD_CDN_HOSTS      = ("cdn.discordapp.com", "media.discordapp.net")
+
+_logger = common.get_logger("Images")
+
+_http_session = None
+
+_cache_files  = None
+_cache_size   = 0
+
+class PreparedImage:
+    def __init__(self, data: bytes, detail: str, image_hash: int) -> None:
+        self.data       = data
+        self.detail     = detail
+        self.image_hash = image_hash
+
+    def to_request(self) -> dict:
+        return {"url": "data:image/jpeg;base64," + base64.b64encode(self.data).decode(), "detail": self.detail}
+
+def get_image_identity(image: str | dict) -> str:
+    if isinstance(image, dict):
+        image = image["url"]
+
+    if image.startswith("data:"):
+        return hashlib.sha256(image.encode()).hexdigest()
+
+    url = urllib.parse.urlsplit(image)
+
+    if url.hostname in _DISCORD_CDN_HOSTS:
+        return url.hostname + url.path
+
+    return image
+
+def _get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=_MAX_CONNECTIONS),
+                                              timeout=aiohttp.ClientTimeout(total=_DOWNLOAD_TIMEOUT_S))
+
+    return _http_session
+
+async def close() -> None:
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+def _get_cache_path(key: str) -> str:
+    return f"{DIR_IMAGE_CACHE}/{key}.jpg"
+
+def _scan_cache() -> OrderedDict:
+    os.makedirs(DIR_IMAGE_CACHE, exist_ok=True)
+
+    files = []
+
+    for entry in os.scandir(DIR_IMAGE_CACHE):
+        # Partial writes left behind by a crash
+        if entry.is_file() and entry.name.endswith(".tmp"):
+            _remove_files([entry.path])
+        elif entry.is_file() and entry.name.endswith(".jpg"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+
+    return OrderedDict((key, size) for _, key, size in sorted(files))
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+def _write_file(path: str, data: bytes) -> None:
+    # Readers only ever see a complete file, even if the process dies mid-write
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove_files([temp_path])
+        raise
+
+def _remove_files(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            _logger.warning(f"Failed to remove cached image {path}: {e}")
+
+# The cache index is only touched from the event loop, worker threads just do file I/O
+async def _init_cache() -> None:
+    global _cache_files, _cache_size
+
+    if _cache_files is None:
+        cache_files = await asyncio.to_thread(_scan_cache)
+
+        if _cache_files is None:
+            _cache_files = cache_files
+            _cache_size  = sum(cache_files.values())
+
+async def _read_cached(key: str) -> bytes | None:
+    await _init_cache()
+
+    if key not in _cache_files:
+        return None
+
+    try:
+        data = await asyncio.to_thread(_read_file, _get_cache_path(key))
+    except OSError:
+        _cache_files.pop(key, None)
+        return None
+
+    if key in _cache_files:
+        _cache_files.move_to_end(key)
+
+    return data
+
+async def _write_cached(key: str, data: bytes) -> None:
+    global _cache_size
+
+    await _init_cache()
+    await asyncio.to_thread(_write_file, _get_cache_path(key), data)
+
+    _cache_size += len(data) - _cache_files.get(key, 0)
+    _cache_files[key] = len(data)
+    _cache_files.move_to_end(key)
+
+    evicted = []
+
+    while _cache_size > _CACHE_MAX_BYTES and len(_cache_files) > 1:
+        old_key, old_size = _cache_files.popitem(last=False)
+        _cache_size -= old_size
+        evicted.append(_get_cache_path(old_key))
+
+    if evicted:
+        await asyncio.to_thread(_remove_files, evicted)
+
+async def _drop_cached(key: str) -> None:
+    global _cache_size
+
+    if key in _cache_files:
+        _cache_size -= _cache_files.pop(key)
+
+    await asyncio.to_thread(_remove_files, [_get_cache_path(key)])
+
+def _get_image_hash(image: Image.Image) -> int:
+    # Difference hash, survives rescaling and recompression
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+
+    for row in range(8):
+        for column in range(8):
+            image_hash = (image_hash << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+
+    return image_hash
+
+def _get_detail(image: Image.Image) -> str:
+    return "low" if max(image.size) <= _LOW_DETAIL_SIDE else "high"
+
+def _downscale(data: bytes) -> bytes:
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    scale = min(1, _MAX_LONG_SIDE / max(image.size), _MAX_SHORT_SIDE / min(image.size))
+
+    if scale < 1:
+        size  = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=_JPEG_QUALITY, optimize=True)
+
+    return output.getvalue()
+
+def _load_prepared(data: bytes) -> PreparedImage:
+    image = Image.open(io.BytesIO(data))
+    return PreparedImage(data, _get_detail(image), _get_image_hash(image))
+
+async def _download(url: str) -> bytes | None:
+    async with _get_http_session().get(url) as response:
+        if response.status != 200 or not response.content_type.startswith("image/"):
+            _logger.warning(f"Can't download image {url}: {response.status} {response.content_type}")
+            return None
+
+        if (response.content_length or 0) > _DOWNLOAD_MAX_BYTES:
+            _logger.warning(f"Image {url} is too large: {response.content_length} bytes")
+            return None
+
+        chunks     = []
+        read_bytes = 0
+
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            chunks.append(chunk)
+            read_bytes += len(chunk)
+
+            if read_bytes > _DOWNLOAD_MAX_BYTES:
+                _logger.warning(f"Image {url} is too large")
+                return None
+
+        return b"".join(chunks)
+
+async def _prepare_image(url: str) -> PreparedImage | None:
+    key  = hashlib.sha256(get_image_identity(url).encode()).hexdigest()
+    data = await _read_cached(key)
+
+    if data is not None:
+        try:
+            image = await asyncio.to_thread(_load_prepared, data)
+            metrics.record_cache("image", True)
+            return image
+        except Exception as e:
+            _logger.warning(f"Dropping unreadable cached image {url}: {e}")
+            await _drop_cached(key)
+
+    metrics.record_cache("image", False)
+
+    try:
+        raw_data = await _download(url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _logger.warning(f"Failed to download image {url}: {e}")
+        return None
+
+    if raw_data is None:
+        return None
+
+    try:
+        data = await asyncio.to_thread(_downscale, raw_data)
+    except Exception as e:
+        _logger.warning(f"Failed to decode image {url}: {e}")
+        return None
+
+    await _write_cached(key, data)
+
+    return await asyncio.to_thread(_load_prepared, data)
+
+def _is_duplicate(image: PreparedImage, kept: list[PreparedImage]) -> bool:
+    return any((image.image_hash ^ other.image_hash).bit_count() <= _DUPLICATE_MAX_DISTANCE for other in kept)
+
+async def prepare_images(urls: list[str]) -> list[str | dict]:
+    prepared = await asyncio.gather(*(_prepare_image(url) for url in urls))
+    kept     = []
+    images   = []
+
+    for url, image in zip(urls, prepared):
+        if image is None:
+            # Let the model try to fetch it itself
+            images.append(url)
+            continue
+
+        if _is_duplicate(image, kept):
+            _logger.debug(f"Dropping duplicate image {url}")
+            continue
+
+        kept.append(image)
+        images.append(image.to_request())
+
+    return images
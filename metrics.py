@@ -0,0 +1,214 @@
+import bisect
+import common
+import contextlib
+import time
+
+from aiohttp import web
+from typing import Callable
+
+_CONTENT_TYPE    = "text/plain; version=0.0.4; charset=utf-8"
+_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+
+# USD per 1M prompt and completion tokens
+_MODEL_PRICES = {
+    "gpt-4-turbo-preview"    : (10.0, 30.0),
+    "gpt-4-vision-preview"   : (10.0, 30.0),
+    "gpt-4o-2024-08-06"      : (2.5,  10.0),
+    "gpt-4o-mini-2024-07-18" : (0.15, 0.6),
+    "gpt-3.5-turbo"          : (0.5,  1.5),
+}
+
+_logger = common.get_logger("Metrics")
+
+# Guild the current task is working for, shared with the logs as their correlation id
+current_guild = common.current_guild
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name    = name
+        self.help    = help
+        self.labels  = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def items(self) -> list[tuple[tuple, float]]:
+        return list(self._values.items())
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: list[float] = _LATENCY_BUCKETS) -> None:
+        self.name     = name
+        self.help     = help
+        self.labels   = labels
+        self.buckets  = buckets
+        self._counts  = {}
+        self._sums    = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        if label_values not in self._counts:
+            self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            self._sums[label_values]   = 0
+
+        self._counts[label_values][bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def get_count(self, *label_values) -> int:
+        return sum(self._counts.get(label_values, []))
+
+    def get_quantile(self, quantile: float, *label_values) -> float:
+        counts = self._counts.get(label_values)
+
+        if not counts:
+            return 0
+
+        # Upper bound of the bucket the quantile falls into
+        target     = quantile * sum(counts)
+        cumulative = 0
+
+        for i, count in enumerate(counts):
+            cumulative += count
+
+            if cumulative >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+
+        return float("inf")
+
+    def label_sets(self) -> list[tuple]:
+        return list(self._counts)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for label_values, counts in self._counts.items():
+            cumulative = 0
+
+            for bucket, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labels + ("le",), label_values + (_format_bucket(bucket),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {self._sums[label_values]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+class Gauge:
+    def __init__(self, name: str, help: str, callback: Callable[[], float]) -> None:
+        self.name     = name
+        self.help     = help
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        try:
+            value = self.callback()
+        except Exception as e:
+            _logger.error(f"Failed to collect {self.name}: {e}")
+            return []
+
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+def _format_bucket(bucket: float) -> str:
+    return "+Inf" if bucket == float("inf") else str(bucket)
+
+def _format_labels(labels: tuple[str, ...], label_values: tuple) -> str:
+    if not labels:
+        return ""
+
+    pairs = []
+
+    for label, value in zip(labels, label_values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{label}=\"{value}\"")
+
+    return "{" + ",".join(pairs) + "}"
+
+stage_seconds       = Histogram("bugbot_stage_seconds", "Time spent in each stage of a report", ("stage",))
+llm_request_seconds = Histogram("bugbot_llm_request_seconds", "OpenAI request latency", ("model",))
+llm_tokens          = Counter("bugbot_llm_tokens_total", "LLM tokens used", ("model", "guild", "kind"))
+llm_cost            = Counter("bugbot_llm_cost_usd_total", "Estimated LLM cost in USD", ("model", "guild"))
+cache_requests      = Counter("bugbot_cache_requests_total", "Cache lookups", ("cache", "result"))
+reports             = Counter("bugbot_reports_total", "Finished reports", ("result",))
+llm_routes          = Counter("bugbot_llm_routes_total", "Models chosen for LLM tasks", ("task", "model", "reason"))
+llm_fallbacks       = Counter("bugbot_llm_fallbacks_total", "LLM requests moved to another model after a failure",
+                              ("task", "model", "error"))
+llm_task_seconds    = Histogram("bugbot_llm_task_seconds", "LLM latency per task and model", ("task", "model"))
+
+_metrics = [stage_seconds, llm_request_seconds, llm_tokens, llm_cost, cache_requests, reports, llm_routes,
+            llm_fallbacks, llm_task_seconds]
+
+_server_runner = None
+
+def register_gauge(name: str, help: str, callback: Callable[[], float]) -> None:
+    _metrics.append(Gauge(name, help, callback))
+
+@contextlib.contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage)
+
+def record_cache(cache: str, hit: bool) -> None:
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = _MODEL_PRICES.get(model, (0, 0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+def record_llm_usage(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    guild = str(current_guild.get())
+
+    llm_tokens.inc(model, guild, "prompt", amount=prompt_tokens)
+    llm_tokens.inc(model, guild, "completion", amount=completion_tokens)
+
+    if model in _MODEL_PRICES:
+        llm_cost.inc(model, guild, amount=estimate_cost(model, prompt_tokens, completion_tokens))
+
+def get_cache_hit_rate(cache: str) -> float:
+    hits  = cache_requests.get(cache, "hit")
+    total = hits + cache_requests.get(cache, "miss")
+
+    return hits / total if total else 0
+
+def render() -> str:
+    lines = []
+
+    for metric in _metrics:
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": _CONTENT_TYPE})
+
+async def start_server(host: str, port: int) -> None:
+    global _server_runner
+
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+
+    _server_runner = web.AppRunner(app, access_log=None)
+    await _server_runner.setup()
+    await web.TCPSite(_server_runner, host, port).start()
+
+    _logger.info(f"Serving metrics on {host}:{port}")
+
+async def stop_server() -> None:
+    if _server_runner:
+        await _server_runner.cleanup()
@@ -0,0 +1,196 @@
+import asyncio
+import chatproc
+import common
+import datetime
+import dedupe
+import discord
+import metrics
+import state
+
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+# Messages further apart than this start a new conversation
+_CONVERSATION_GAP_S        = 60 * 20
+_MIN_CONVERSATION_MESSAGES = 3
+_MAX_CONVERSATION_MESSAGES = 50
+
+_MAX_SCAN_MESSAGES         = 10000
+_MAX_IMAGES                = 3
+
+# Workers per stage, LLM requests are additionally bounded by the per-model limits in gpt
+_IMAGE_WORKERS             = 2
+_ANALYSIS_WORKERS          = 4
+_DEDUPE_WORKERS            = 4
+_DRAFT_WORKERS             = 2
+
+_logger = common.get_logger("Scan")
+
+# Tells a stage worker there are no more items
+_DONE = object()
+
+Handler = Callable[[Any], Awaitable[Any]]
+
+class Pipeline:
+    def __init__(self, stages: list[tuple[str, Handler, int]]) -> None:
+        self._stages   = stages
+        self.queued    = 0
+        self.processed = {name: 0 for name, _, _ in stages}
+        self.failed    = 0
+
+    async def _work(self, index: int, queues: list[asyncio.Queue], results: list) -> None:
+        name, handler, _ = self._stages[index]
+
+        while True:
+            item = await queues[index].get()
+
+            if item is _DONE:
+                return
+
+            try:
+                with metrics.timed(f"scan_{name}"):
+                    item = await handler(item)
+            except Exception as e:
+                _logger.exception(f"Scan stage {name} failed: {e}")
+                self.failed += 1
+                continue
+            finally:
+                self.processed[name] += 1
+
+            # Handlers drop items by returning None
+            if item is None:
+                continue
+
+            if index + 1 < len(self._stages):
+                await queues[index + 1].put(item)
+            else:
+                results.append(item)
+
+    async def run(self, source: AsyncIterator) -> list:
+        # Bounded queues keep a fast stage from running far ahead of a slow one
+        queues  = [asyncio.Queue(workers * 2) for _, _, workers in self._stages]
+        results = []
+        workers = [[asyncio.create_task(self._work(index, queues, results)) for _ in range(num_workers)]
+                   for index, (_, _, num_workers) in enumerate(self._stages)]
+
+        try:
+            async for item in source:
+                self.queued += 1
+                await queues[0].put(item)
+
+            # A stage is finished once all of its workers are, so everything it produced is queued
+            for queue, stage_workers in zip(queues, workers):
+                for _ in stage_workers:
+                    await queue.put(_DONE)
+
+                await asyncio.gather(*stage_workers)
+        finally:
+            for stage_workers in workers:
+                for worker in stage_workers:
+                    worker.cancel()
+
+        return results
+
+class Conversation:
+    def __init__(self, messages: list[discord.Message]) -> None:
+        self.messages           = messages
+        self.image_descriptions = {}
+        self.issue              = None
+        self.signature          = None
+        self.duplicates         = []
+        self.similar_to         = None
+        self.title              = None
+        self.markdown           = None
+
+    def get_start(self) -> discord.Message:
+        return self.messages[0]
+
+    def get_author_name(self) -> str:
+        return self.messages[0].author.name
+
+async def find_conversations(channel: discord.TextChannel, after: datetime.datetime,
+                             before: datetime.datetime) -> AsyncIterator[Conversation]:
+    messages = []
+
+    # Conversations are handed out as soon as they end, so analysis overlaps with reading the channel
+    async for message in channel.history(limit=_MAX_SCAN_MESSAGES, after=after, before=before, oldest_first=True):
+        if message.author.bot:
+            continue
+
+        if messages and ((message.created_at - messages[-1].created_at).total_seconds() > _CONVERSATION_GAP_S
+                         or len(messages) >= _MAX_CONVERSATION_MESSAGES):
+            if len(messages) >= _MIN_CONVERSATION_MESSAGES:
+                yield Conversation(messages)
+
+            messages = []
+
+        messages.append(message)
+
+    if len(messages) >= _MIN_CONVERSATION_MESSAGES:
+        yield Conversation(messages)
+
+def make_pipeline(guild_id: int, hint: str) -> Pipeline:
+    drafted = []
+
+    async def describe_images(conversation: Conversation) -> Conversation:
+        conversation.image_descriptions = await chatproc.describe_images(guild_id, conversation.messages,
+                                                                         conversation.get_author_name(), _MAX_IMAGES)
+        return conversation
+
+    async def extract_issue(conversation: Conversation) -> Conversation:
+        config   = await state.get_config(guild_id)
+        chat_log = await chatproc.format_history(guild_id, conversation.messages, conversation.get_author_name(),
+                                                 config.chat_token_budget, conversation.image_descriptions)
+
+        analysis_suite     = await state.get_analysis_suite(guild_id)
+        conversation.issue = await analysis_suite.analyse_issue(chat_log, hint)
+
+        return conversation if conversation.issue else None
+
+    async def find_duplicates(conversation: Conversation) -> Conversation:
+        config     = await state.get_config(guild_id)
+        issue_text = dedupe.get_issue_text(conversation.issue)
+
+        try:
+            conversation.duplicates = await dedupe.find_duplicates(config.github_repo, issue_text)
+        except Exception as e:
+            _logger.error(f"Failed to look up duplicates: {e}")
+
+        # Threads about the same bug are common after a release, point them at the first one
+        conversation.signature = dedupe.get_signature(issue_text)
+
+        for other in drafted:
+            if dedupe.is_similar(conversation.signature, other.signature):
+                conversation.similar_to = other
+                break
+
+        drafted.append(conversation)
+
+        return conversation
+
+    async def make_draft(conversation: Conversation) -> Conversation:
+        analysis_suite = await state.get_analysis_suite(guild_id)
+        draft          = analysis_suite.make_markdown(conversation.issue)
+
+        if draft is None:
+            return None
+
+        conversation.title, conversation.markdown = draft
+
+        return conversation
+
+    return Pipeline([
+        ("images",   describe_images, _IMAGE_WORKERS),
+        ("analysis", extract_issue,   _ANALYSIS_WORKERS),
+        ("dedupe",   find_duplicates, _DEDUPE_WORKERS),
+        ("draft",    make_draft,      _DRAFT_WORKERS)
+    ])
+
+async def scan_channel(pipeline: Pipeline, channel: discord.TextChannel, after: datetime.datetime,
+                       before: datetime.datetime) -> list[Conversation]:
+    drafts = await pipeline.run(find_conversations(channel, after, before))
+    drafts.sort(key=lambda conversation: conversation.get_start().created_at)
+
+    _logger.info(f"Scanned {pipeline.queued} conversations in #{channel.name}, {len(drafts)} drafts, "
+                 f"{pipeline.failed} failed")
+
+    return drafts
@@ -1,36 +1,239 @@
 import asyncio
 import common
+import contextlib
+import json
 import storage
 import time
 
+from collections import OrderedDict
+from collections import deque
 from storage import Config
 from analysis import AnalysisSuite
+from typing import Awaitable, Callable, Optional
 
 # Purge old states after 2 days of inactivity
-_PURGE_TIME_S = 60 * 60 * 24 * 2
+_PURGE_TIME_S     = 60 * 60 * 24 * 2
+_PURGE_INTERVAL_S = 60 * 10
+
+# Bounds of the state cache, least recently used idle states are evicted first
+_MAX_STATES       = 10000
+_MAX_STATES_BYTES = 256 * 1024 * 1024
+
+# Rough fixed overhead of a state and its objects
+_STATE_BASE_BYTES = 4 * 1024
+
+# Sharded deployments hold a Mongo lease per guild report slot while a report runs
+_LEASE_TTL_S      = 60
+_LEASE_RENEW_S    = 20
+_LEASE_RETRY_S    = 2
 
 _logger = common.get_logger("State")
 
 _lock = asyncio.Lock()
-_states = {}
 
-class State:
+# Configs bulk loaded at startup, consumed when the guild's state is created
+_preloaded_configs = {}
+
+# Set by init() when other processes may serve the same guilds
+_lease_owner       = None
+_held_leases       = set()
+_config_watch_task = None
+
+# Called with the queue position of a waiting job, and with 0 once it starts
+PositionCallback = Callable[[int], Awaitable[None]]
+
+async def _notify_position(callback: PositionCallback, position: int) -> None:
+    try:
+        await callback(position)
+    except Exception as e:
+        _logger.error(f"Error notifying queue position: {e}")
+
+class _JobQueue:
+    def __init__(self, concurrency: int) -> None:
+        self._concurrency = max(1, concurrency)
+        self._active      = 0
+        self._waiters     = deque()
+
+    def is_idle(self) -> bool:
+        return self._active == 0 and not self._waiters
+
+    def get_depth(self) -> int:
+        return len(self._waiters)
+
+    def get_active(self) -> int:
+        return self._active
+
+    def set_concurrency(self, concurrency: int) -> None:
+        self._concurrency = max(1, concurrency)
+
+        while self._waiters and self._active < self._concurrency:
+            self._active += 1
+            self._wake_next()
+
+    def _wake_next(self) -> None:
+        # Waiters cancelled in the same tick are still queued, the slot goes to the next live one
+        while self._waiters:
+            future, _ = self._waiters.popleft()
+
+            if not future.done():
+                future.set_result(None)
+                break
+        else:
+            self._active -= 1
+
+        for position, (_, callback) in enumerate(self._waiters, 1):
+            if callback:
+                asyncio.create_task(_notify_position(callback, position))
+
+    async def acquire(self, on_position: Optional[PositionCallback] = None) -> None:
+        if self._active < self._concurrency and not self._waiters:
+            self._active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, on_position)
+        self._waiters.append(waiter)
+
+        try:
+            if on_position:
+                await _notify_position(on_position, len(self._waiters))
+
+            await future
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif future.done() and not future.cancelled():
+                # The slot was handed over while we were being cancelled
+                self.release()
+
+            raise
+
+        if on_position:
+            await _notify_position(on_position, 0)
+
+    def release(self) -> None:
+        # Hand the slot directly to the next waiter so it can't be stolen
+        if self._waiters and self._active <= self._concurrency:
+            self._wake_next()
+        else:
+            self._active -= 1
+
+class LeaseLostError(Exception):
+    pass
+
+class _JobLease:
     def __init__(self, guild_id: int) -> None:
+        self._guild_id   = guild_id
+        self._key        = None
+        self._lost       = False
+        self._renew_task = None
+        self.token       = 0
+
+    async def acquire(self, slots: int) -> None:
+        if _lease_owner is None:
+            return
+
+        # Another process only holds a slot while shards are being moved, so polling is enough
+        while True:
+            for slot in range(max(1, slots)):
+                key = f"{self._guild_id}:{slot}"
+
+                if key in _held_leases:
+                    continue
+
+                token = await storage.acquire_lease(key, _lease_owner, _LEASE_TTL_S)
+
+                if token is not None:
+                    self._key        = key
+                    self.token       = token
+                    self._renew_task = asyncio.create_task(self._renew())
+                    _held_leases.add(key)
+                    return
+
+            await asyncio.sleep(_LEASE_RETRY_S)
+
+    async def _renew(self) -> None:
+        while True:
+            await asyncio.sleep(_LEASE_RENEW_S)
+
+            try:
+                if not await storage.renew_lease(self._key, _lease_owner, self.token, _LEASE_TTL_S):
+                    _logger.warning(f"Lease {self._key} was taken over")
+                    self._lost = True
+                    return
+            except Exception as e:
+                _logger.error(f"Failed to renew lease {self._key}: {e}")
+
+    async def check(self) -> None:
+        if self._key is None:
+            return
+
+        # The fencing token changes whenever someone else takes the lease
+        if self._lost or not await storage.renew_lease(self._key, _lease_owner, self.token, _LEASE_TTL_S):
+            self._lost = True
+            raise LeaseLostError(f"Lease {self._key} was lost")
+
+    async def release(self) -> None:
+        if self._key is None:
+            return
+
+        self._renew_task.cancel()
+        _held_leases.discard(self._key)
+
+        try:
+            await storage.release_lease(self._key, _lease_owner, self.token)
+        except Exception as e:
+            _logger.error(f"Failed to release lease {self._key}: {e}")
+
+class State:
+    def __init__(self, guild_id: int, config: Optional[Config] = None) -> None:
         self._guild_id       = guild_id
         self._analysis_suite = AnalysisSuite(guild_id)
-        self._config         = storage.get_config(guild_id)
+        self._config         = config
         self._last_use       = time.time()
-        self._busy           = False
+        self._jobs           = _JobQueue(config.max_concurrent_reports if config else 1)
+        self._verification   = None
+        self._init_task      = None
+        self._reinit_task    = None
+
+    async def _load(self) -> None:
+        if self._config is None:
+            self._config = await storage.get_config(self._guild_id)
+            self._jobs.set_concurrency(self._config.max_concurrent_reports)
 
     async def _init(self) -> None:
-        await self._analysis_suite._init()
+        # The suite gets the config directly, asking state for it here would wait on this very init
+        await self._analysis_suite._init(self._config)
+        _states.resize(self)
+
+    async def _load_and_init(self) -> None:
+        await self._load()
+        _states.resize(self)
+        await self._init()
+
+    async def _reinit(self) -> None:
+        try:
+            await self._init()
+        except Exception as e:
+            _logger.exception(f"Error reinitialising state for guild {self._guild_id}: {e}")
+
+    def _estimate_size(self) -> int:
+        size = _STATE_BASE_BYTES + self._analysis_suite.estimate_size()
+
+        if self._config:
+            size += len(json.dumps(self._config.to_dict()))
+
+        return size
 
     def _update_last_use(self) -> None:
         self._last_use = time.time()
 
     def _set_config(self, config: Config) -> None:
         self._config = config
+        self._jobs.set_concurrency(config.max_concurrent_reports)
+        self._verification = None
         self._update_last_use()
+        _states.resize(self)
 
     def _get_analysis_suite(self) -> AnalysisSuite:
         self._update_last_use()
@@ -40,42 +243,149 @@ class State:
         self._update_last_use()
         return self._config
 
+class _StateCache:
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self._states      = OrderedDict()
+        self._sizes       = {}
+        self._size        = 0
+        self._max_entries = max_entries
+        self._max_bytes   = max_bytes
+        self.hits         = 0
+        self.misses       = 0
+        self.evictions    = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._states
+
+    def _is_full(self) -> bool:
+        return len(self._states) > self._max_entries or self._size > self._max_bytes
+
+    def peek(self, guild_id: int) -> Optional[State]:
+        return self._states.get(guild_id)
+
+    def get(self, guild_id: int) -> Optional[State]:
+        state = self._states.get(guild_id)
+
+        if state is None:
+            self.misses += 1
+            return None
+
+        self._states.move_to_end(guild_id)
+        self.hits += 1
+
+        return state
+
+    def add(self, state: State) -> None:
+        self._states[state._guild_id] = state
+        self._sizes[state._guild_id]  = 0
+        self.resize(state)
+
+    def resize(self, state: State) -> None:
+        if self._states.get(state._guild_id) is not state:
+            return
+
+        size = state._estimate_size()
+        self._size += size - self._sizes[state._guild_id]
+        self._sizes[state._guild_id] = size
+
+        if self._is_full():
+            self._evict()
+
+    def remove(self, state: State) -> None:
+        if self._states.get(state._guild_id) is state:
+            del self._states[state._guild_id]
+            self._size -= self._sizes.pop(state._guild_id)
+
+    def _pop_oldest_idle(self, cutoff: float = None) -> bool:
+        # Guilds with running or queued reports are in use, so they count as recently used
+        for _ in range(len(self._states)):
+            state = next(iter(self._states.values()))
+
+            if cutoff is not None and state._last_use > cutoff:
+                return False
+
+            if state._jobs.is_idle():
+                self.remove(state)
+                self.evictions += 1
+                return True
+
+            self._states.move_to_end(state._guild_id)
+
+        return False
+
+    def _evict(self) -> None:
+        while self._is_full() and self._pop_oldest_idle():
+            pass
+
+    def purge_idle(self, max_idle_s: float) -> None:
+        cutoff = time.time() - max_idle_s
+        purged = 0
+
+        # States are kept in order of use, so this stops at the first recently used one
+        while self._pop_oldest_idle(cutoff):
+            purged += 1
+
+        if purged:
+            _logger.info(f"Purged {purged} idle guild states")
+
+    def get_stats(self) -> dict:
+        return {
+            "entries"   : len(self._states),
+            "bytes"     : self._size,
+            "hits"      : self.hits,
+            "misses"    : self.misses,
+            "evictions" : self.evictions,
+            "active"    : sum(state._jobs.get_active() for state in self._states.values()),
+            "queued"    : sum(state._jobs.get_depth() for state in self._states.values())
+        }
+
+_states = _StateCache(_MAX_STATES, _MAX_STATES_BYTES)
+
 async def _purge_states() -> None:
-    global _states
+    while True:
+        await asyncio.sleep(_PURGE_INTERVAL_S)
 
-    _logger.debug("Checking for states to purge...")
+        _logger.debug("Checking for states to purge...")
 
-    async with _lock:
-        for guild_id in list(_states):
-            state = _states[guild_id]
-            if time.time() - state._last_use > _PURGE_TIME_S and not state._busy:
-                _logger.info(f"Purging state for guild {guild_id}")
-                del _states[guild_id]
+        try:
+            async with _lock:
+                _states.purge_idle(_PURGE_TIME_S)
 
-    await asyncio.sleep(60 * 10)
-    await _purge_states()
+            _logger.debug(f"State cache: {_states.get_stats()}")
+        except Exception as e:
+            _logger.exception(f"Error purging states: {e}")
 
 _purge_task = None
 def _schedule_purge_states() -> None:
     global _purge_task
-    _purge_task = asyncio.create_task(_purge_states())
+
+    if _purge_task is None or _purge_task.done():
+        _purge_task = asyncio.create_task(_purge_states())
 
 async def _get_state(guild_id: int) -> State:
-    global _states
     state = None
-    needs_init = False
 
+    # Storage is only awaited outside the global lock so one cold guild doesn't stall the others
     async with _lock:
-        if guild_id not in _states:
-            state = _states[guild_id] = State(guild_id)
-            needs_init = True
-        else:
-            state = _states[guild_id]
+        state = _states.get(guild_id)
+
+        if state is None:
+            state = State(guild_id, _preloaded_configs.pop(guild_id, None))
+            state._init_task = asyncio.create_task(state._load_and_init())
+            _states.add(state)
 
     state._update_last_use()
 
-    if needs_init:
-        await state._init()
+    # Everyone waits for the same init, so a state is never handed out half built
+    try:
+        await asyncio.shield(state._init_task)
+    except Exception:
+        async with _lock:
+            _states.remove(state)
+        raise
 
     return state
 
@@ -90,15 +400,81 @@ async def get_config(guild_id: int) -> Config:
 async def set_config(guild_id: int, config: Config) -> None:
     state = await _get_state(guild_id)
     state._set_config(config)
-    storage.set_config(guild_id, config)
+    await storage.set_config(guild_id, config)
+
+    # Prompts and field names depend on the config, rebuild them without holding up the caller
+    state._reinit_task = asyncio.create_task(state._reinit())
+
+async def get_config_verification(guild_id: int, fingerprint: str) -> Optional[float]:
+    state = await _get_state(guild_id)
+
+    if state._verification and state._verification[0] == fingerprint:
+        return state._verification[1]
+
+    return None
+
+async def set_config_verification(guild_id: int, fingerprint: str) -> None:
+    state = await _get_state(guild_id)
+    state._verification = (fingerprint, time.time())
+
+async def preload_configs(guild_ids: list[int]) -> dict[int, Config]:
+    configs = await storage.get_configs(guild_ids)
+
+    async with _lock:
+        for guild_id, config in configs.items():
+            if guild_id not in _states:
+                _preloaded_configs[guild_id] = config
+
+    _logger.info(f"Preloaded configs for {len(configs)} guilds")
+
+    return configs
+
+async def _on_remote_config(guild_id: int, config: Config) -> None:
+    # Writes of this process come back through the change stream too, possibly older than a pending one
+    if storage.is_config_pending(guild_id):
+        return
+
+    async with _lock:
+        if guild_id in _preloaded_configs:
+            _preloaded_configs[guild_id] = config
+
+        state = _states.peek(guild_id)
+
+    if state is None or state._config is None or state._config.fingerprint() == config.fingerprint():
+        return
+
+    _logger.info(f"Config for guild {guild_id} was changed by another process")
+
+    state._set_config(config)
+    state._reinit_task = asyncio.create_task(state._reinit())
+
+def get_cache_stats() -> dict:
+    return _states.get_stats()
+
+def init(lease_owner: Optional[str] = None) -> None:
+    global _lease_owner, _config_watch_task
 
-def init() -> None:
     _schedule_purge_states()
 
-async def set_busy(guild_id: int, busy: bool) -> None:
+    if lease_owner and _config_watch_task is None:
+        _lease_owner       = lease_owner
+        _config_watch_task = asyncio.create_task(storage.watch_configs(_on_remote_config))
+
+@contextlib.asynccontextmanager
+async def report_job(guild_id: int, on_position: Optional[PositionCallback] = None):
     state = await _get_state(guild_id)
-    state._busy = busy
+    await state._jobs.acquire(on_position)
+
+    lease = _JobLease(guild_id)
+
+    try:
+        await lease.acquire(state._config.max_concurrent_reports)
+        yield lease
+    finally:
+        await lease.release()
+        state._jobs.release()
+        state._update_last_use()
 
-async def get_busy(guild_id: int) -> bool:
+async def get_queue_depth(guild_id: int) -> int:
     state = await _get_state(guild_id)
-    return state._busy
+    return state._jobs.get_depth()
@@ -1,13 +1,46 @@
+import asyncio
 import common
+import datetime
+import hashlib
+import json
 
-from pymongo.collection import Collection
-from pymongo.mongo_client import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import OperationFailure
 from pymongo.server_api import ServerApi
+from typing import Awaitable, Callable
 
 _logger = common.get_logger("Storage")
 
 _mongo_client  = None
 
+# LLM result cache is trimmed to its least recently used entries every few inserts
+_LLM_CACHE_MAX_ENTRIES   = 50000
+_LLM_CACHE_TRIM_INTERVAL = 200
+
+# Config writes are coalesced and flushed in one bulk write after this delay
+_WRITE_BEHIND_DELAY_S    = 2
+
+# Maximum number of ids in a single $in query
+_PRELOAD_BATCH_SIZE      = 1000
+
+# Report drafts waiting for review are kept this long after their last change
+_DRAFT_TTL_S             = 60 * 60 * 24 * 7
+
+# Wait before reopening a config change stream that failed
+_WATCH_RETRY_S           = 5
+
+# Resume point of a change stream is no longer in the oplog
+_CHANGE_STREAM_HISTORY_LOST = 286
+
+_llm_cache_inserts = 0
+
+_pending_configs = {}
+_flush_task      = None
+
 class Config:
     def __init__(self, data: dict = {}) -> None:
         if len(data) > 1:
@@ -17,6 +50,12 @@ class Config:
             self.issue_categories       = data.get("issue_categories")
             self.issue_extra_info       = data.get("issue_extra_info")
             self.discord_developer_role = data.get("discord_developer_role")
+            self.max_concurrent_reports = data.get("max_concurrent_reports", 1)
+            self.single_pass_analysis   = data.get("single_pass_analysis", False)
+            self.chat_token_budget      = data.get("chat_token_budget", 6000)
+            self.llm_cost_budget        = data.get("llm_cost_budget", 0)
+            self.llm_latency_budget     = data.get("llm_latency_budget", 0)
+            self.prefetch_alternatives  = data.get("prefetch_alternatives", False)
         else:
             self.github_repo            = ""
             self.product_name           = "Product Name"
@@ -24,6 +63,12 @@ class Config:
             self.issue_categories       = []
             self.issue_extra_info       = []
             self.discord_developer_role = "Developer"
+            self.max_concurrent_reports = 1
+            self.single_pass_analysis   = False
+            self.chat_token_budget      = 6000
+            self.llm_cost_budget        = 0
+            self.llm_latency_budget     = 0
+            self.prefetch_alternatives  = False
 
     def get_pretty_name(self, field: str) -> str:
         return {
@@ -32,7 +77,13 @@ class Config:
             "product_type"           : "Product Type",
             "issue_categories"       : "Issue Categories",
             "issue_extra_info"       : "Issue Extra Information",
-            "discord_developer_role" : "Discord Developer Role"
+            "discord_developer_role" : "Discord Developer Role",
+            "max_concurrent_reports" : "Max Concurrent Reports",
+            "single_pass_analysis"   : "Single Pass Analysis",
+            "chat_token_budget"      : "Chat Token Budget",
+            "llm_cost_budget"        : "LLM Cost Budget",
+            "llm_latency_budget"     : "LLM Latency Budget",
+            "prefetch_alternatives"  : "Prefetch Alternatives"
         }[field]
 
     def to_dict(self) -> dict:
@@ -42,48 +93,283 @@ class Config:
             "product_type"           : self.product_type,
             "issue_categories"       : self.issue_categories,
             "issue_extra_info"       : self.issue_extra_info,
-            "discord_developer_role" : self.discord_developer_role
+            "discord_developer_role" : self.discord_developer_role,
+            "max_concurrent_reports" : self.max_concurrent_reports,
+            "single_pass_analysis"   : self.single_pass_analysis,
+            "chat_token_budget"      : self.chat_token_budget,
+            "llm_cost_budget"        : self.llm_cost_budget,
+            "llm_latency_budget"     : self.llm_latency_budget,
+            "prefetch_alternatives"  : self.prefetch_alternatives
         }
 
-def init(mongo_uri: str) -> None:
-    global _mongo_client
-    _logger.info(f"Connecting to MongoDB...")
-    _mongo_client = MongoClient(mongo_uri, server_api=ServerApi('1'))
+    def fingerprint(self) -> str:
+        return hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()
 
+async def _ping() -> None:
     try:
-        _mongo_client.admin.command('ping')
+        await _mongo_client.admin.command('ping')
         _logger.info("Connection to MongoDB successful")
     except Exception as e:
         _logger.critical(e)
 
-def _get_guild_info_collection() -> Collection:
+async def init(mongo_uri: str) -> None:
+    global _mongo_client
+    _logger.info(f"Connecting to MongoDB...")
+    _mongo_client = AsyncIOMotorClient(mongo_uri, server_api=ServerApi('1'))
+
+    # Index builds don't depend on each other or on the ping, they share the connection pool
+    await asyncio.gather(_ping(), _init_llm_cache_indexes(), _init_issue_index_indexes(), _init_draft_indexes())
+
+def _get_guild_info_collection() -> AsyncIOMotorCollection:
     database = _mongo_client.get_database("discord_bugbot")
     return database.get_collection("guild_info")
 
-def _add_document(collection : Collection, key: str) -> None:
-    collection.insert_one({"_id" : key})
+def _get_guild_artifacts_collection() -> AsyncIOMotorCollection:
+    database = _mongo_client.get_database("discord_bugbot")
+    return database.get_collection("guild_artifacts")
+
+def _get_issue_index_collection() -> AsyncIOMotorCollection:
+    database = _mongo_client.get_database("discord_bugbot")
+    return database.get_collection("issue_index")
+
+def _get_lease_collection() -> AsyncIOMotorCollection:
+    database = _mongo_client.get_database("discord_bugbot")
+    return database.get_collection("guild_leases")
+
+def _get_draft_collection() -> AsyncIOMotorCollection:
+    database = _mongo_client.get_database("discord_bugbot")
+    return database.get_collection("report_drafts")
+
+def _get_llm_cache_collection() -> AsyncIOMotorCollection:
+    database = _mongo_client.get_database("discord_bugbot")
+    return database.get_collection("llm_cache")
+
+async def _init_llm_cache_indexes() -> None:
+    try:
+        collection = _get_llm_cache_collection()
+        await collection.create_index("expires", expireAfterSeconds=0)
+        await collection.create_index("used")
+    except Exception as e:
+        _logger.error(f"Failed to create LLM cache indexes: {e}")
+
+async def _init_draft_indexes() -> None:
+    try:
+        await _get_draft_collection().create_index("expires", expireAfterSeconds=0)
+    except Exception as e:
+        _logger.error(f"Failed to create draft indexes: {e}")
+
+async def _init_issue_index_indexes() -> None:
+    try:
+        await _get_issue_index_collection().create_index([("repo", 1), ("bands", 1)])
+    except Exception as e:
+        _logger.error(f"Failed to create issue index indexes: {e}")
+
+async def _trim_llm_cache(collection: AsyncIOMotorCollection) -> None:
+    excess = await collection.estimated_document_count() - _LLM_CACHE_MAX_ENTRIES
+
+    if excess <= 0:
+        return
+
+    oldest = await collection.find({}, {"_id" : 1}).sort("used", 1).limit(excess).to_list(None)
+    await collection.delete_many({"_id" : {"$in" : [document["_id"] for document in oldest]}})
+
+    _logger.info(f"Evicted {excess} LLM cache entries")
+
+async def get_llm_result(key: str) -> str | dict | None:
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    document = await _get_llm_cache_collection().find_one_and_update({"_id" : key, "expires" : {"$gt" : now}},
+                                                                     {"$set" : {"used" : now}},
+                                                                     projection={"result" : 1},
+                                                                     return_document=ReturnDocument.AFTER)
+
+    return document["result"] if document else None
+
+async def put_llm_result(key: str, result: str | dict, ttl: int) -> None:
+    global _llm_cache_inserts
+
+    now        = datetime.datetime.now(datetime.timezone.utc)
+    collection = _get_llm_cache_collection()
+
+    await collection.update_one({"_id" : key},
+                                {"$set" : {"result"  : result,
+                                           "used"    : now,
+                                           "expires" : now + datetime.timedelta(seconds=ttl)}},
+                                upsert=True)
+
+    _llm_cache_inserts += 1
 
-def _fetch(key: str) -> dict:
-    object = {}
+    if _llm_cache_inserts % _LLM_CACHE_TRIM_INTERVAL == 0:
+        await _trim_llm_cache(collection)
 
-    collection =_get_guild_info_collection()
-    object = collection.find_one(key)
+async def _fetch(key: str) -> dict:
+    # Creates the document if it doesn't exist yet, in a single round trip
+    return await _get_guild_info_collection().find_one_and_update({"_id" : key},
+                                                                  {"$setOnInsert" : {"_id" : key}},
+                                                                  upsert=True,
+                                                                  return_document=ReturnDocument.AFTER)
 
-    if object is None:
-        _add_document(collection, key)
-        return {"_id" : key}
+async def _fetch_many(keys: list[str]) -> list[dict]:
+    collection = _get_guild_info_collection()
+    objects    = []
+
+    for i in range(0, len(keys), _PRELOAD_BATCH_SIZE):
+        objects += await collection.find({"_id" : {"$in" : keys[i:i + _PRELOAD_BATCH_SIZE]}}).to_list(None)
 
-    return object
+    return objects
 
-def _push(key: str, object: dict) -> None:
+async def _push(key: str, object: dict) -> None:
     collection = _get_guild_info_collection()
-    collection.update_one({"_id" : key}, { "$set": object }, upsert=True)
+    await collection.update_one({"_id" : key}, { "$set": object }, upsert=True)
+
+async def flush() -> None:
+    global _pending_configs
+
+    if not _pending_configs:
+        return
+
+    pending, _pending_configs = _pending_configs, {}
+
+    try:
+        await _get_guild_info_collection().bulk_write([UpdateOne({"_id" : key}, {"$set" : object}, upsert=True)
+                                                       for key, object in pending.items()], ordered=False)
+    except Exception as e:
+        _logger.error(f"Failed to flush {len(pending)} config writes: {e}")
+
+        # Keep newer writes that arrived during the failed flush
+        _pending_configs = {**pending, **_pending_configs}
+        raise
+
+async def _flush_later() -> None:
+    global _flush_task
+
+    await asyncio.sleep(_WRITE_BEHIND_DELAY_S)
+    _flush_task = None
+
+    try:
+        await flush()
+    except Exception:
+        _schedule_flush()
+
+def _schedule_flush() -> None:
+    global _flush_task
+
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_later())
+
+async def init_config(guild_id: int) -> Config:
+    await _push(str(guild_id), Config().to_dict())
+
+async def get_config(guild_id: int) -> Config:
+    key = str(guild_id)
+
+    if key in _pending_configs:
+        return Config(_pending_configs[key])
+
+    return Config(await _fetch(key))
+
+async def get_configs(guild_ids: list[int]) -> dict[int, Config]:
+    objects = {object["_id"] : object for object in await _fetch_many([str(guild_id) for guild_id in guild_ids])}
+    objects.update(_pending_configs)
+
+    return {guild_id : Config(objects.get(str(guild_id), {})) for guild_id in guild_ids}
+
+def is_config_pending(guild_id: int) -> bool:
+    return str(guild_id) in _pending_configs
+
+async def set_config(guild_id: int, config: Config) -> None:
+    _pending_configs[str(guild_id)] = config.to_dict()
+    _schedule_flush()
+
+async def get_analysis_artifacts(guild_id: int) -> dict | None:
+    return await _get_guild_artifacts_collection().find_one(str(guild_id))
+
+async def set_analysis_artifacts(guild_id: int, artifacts: dict) -> None:
+    await _get_guild_artifacts_collection().replace_one({"_id" : str(guild_id)}, artifacts, upsert=True)
+
+async def put_indexed_issue(repo: str, number: int, issue: dict) -> None:
+    await _get_issue_index_collection().update_one({"_id" : f"{repo}#{number}"},
+                                                   {"$set" : {"repo" : repo, "number" : number, **issue}},
+                                                   upsert=True)
+
+async def find_indexed_issues(repo: str, bands: list[str]) -> list[dict]:
+    return await _get_issue_index_collection().find({"repo" : repo, "bands" : {"$in" : bands}},
+                                                    {"bands" : 0}).to_list(None)
+
+async def put_draft(draft_id: int, draft: dict) -> None:
+    now     = datetime.datetime.now(datetime.timezone.utc)
+    expires = now + datetime.timedelta(seconds=_DRAFT_TTL_S)
+
+    await _get_draft_collection().replace_one({"_id" : draft_id},
+                                              {**draft, "locked_until" : now, "expires" : expires},
+                                              upsert=True)
+
+async def lock_draft(draft_id: int, ttl: float) -> dict | None:
+    now          = datetime.datetime.now(datetime.timezone.utc)
+    locked_until = now + datetime.timedelta(seconds=ttl)
+
+    # Only one button press at a time gets the draft, in whichever process it arrives
+    return await _get_draft_collection().find_one_and_update({"_id" : draft_id, "locked_until" : {"$lte" : now}},
+                                                             {"$set" : {"locked_until" : locked_until}},
+                                                             return_document=ReturnDocument.AFTER)
+
+async def unlock_draft(draft_id: int, changes: dict = {}) -> None:
+    now     = datetime.datetime.now(datetime.timezone.utc)
+    expires = now + datetime.timedelta(seconds=_DRAFT_TTL_S)
+
+    await _get_draft_collection().update_one({"_id" : draft_id},
+                                             {"$set" : {**changes, "locked_until" : now, "expires" : expires}})
+
+async def delete_draft(draft_id: int) -> None:
+    await _get_draft_collection().delete_one({"_id" : draft_id})
+
+async def acquire_lease(key: str, owner: str, ttl: float) -> int | None:
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # A held lease doesn't match, so the upsert tries to insert a second document with the same id and fails
+    try:
+        lease = await _get_lease_collection().find_one_and_update(
+            {"_id" : key, "$or" : [{"owner" : None}, {"expires" : {"$lte" : now}}]},
+            {"$set" : {"owner" : owner, "expires" : now + datetime.timedelta(seconds=ttl)}, "$inc" : {"token" : 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        return None
+
+    return lease["token"]
+
+async def renew_lease(key: str, owner: str, token: int, ttl: float) -> bool:
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+    result  = await _get_lease_collection().update_one({"_id" : key, "owner" : owner, "token" : token},
+                                                       {"$set" : {"expires" : expires}})
+
+    return result.matched_count == 1
+
+async def release_lease(key: str, owner: str, token: int) -> None:
+    await _get_lease_collection().update_one({"_id" : key, "owner" : owner, "token" : token},
+                                             {"$set" : {"owner" : None}})
+
+async def watch_configs(on_change: Callable[[int, Config], Awaitable[None]]) -> None:
+    pipeline     = [{"$match" : {"operationType" : {"$in" : ["insert", "update", "replace"]}}}]
+    resume_token = None
+
+    # Change streams need a replica set, a standalone server makes this fail and retry
+    while True:
+        try:
+            async with _get_guild_info_collection().watch(pipeline, full_document="updateLookup",
+                                                          resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    document     = change.get("fullDocument")
 
-def init_config(guild_id: int) -> Config:
-    _push(str(guild_id), Config().to_dict())
+                    if document and len(document) > 1:
+                        await on_change(int(document["_id"]), Config(document))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _logger.error(f"Config change stream failed: {e}")
 
-def get_config(guild_id: int) -> Config:
-    return Config(_fetch(str(guild_id)))
+            if isinstance(e, OperationFailure) and e.code == _CHANGE_STREAM_HISTORY_LOST:
+                resume_token = None
 
-def set_config(guild_id: int, config: Config) -> None:
-    _push(str(guild_id), config.to_dict())
+            await asyncio.sleep(_WATCH_RETRY_S)
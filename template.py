@@ -0,0 +1,33 @@
+import common
+import hashlib
+import re
+
+_PLACEHOLDER = re.compile(r"@(\w+)@")
+
+_templates = {}
+
+class Template:
+    def __init__(self, text: str) -> None:
+        parts = _PLACEHOLDER.split(text)
+
+        self.text      = text
+        self.hash      = hashlib.sha256(text.encode()).hexdigest()
+        self._literals = parts[0::2]
+        self._names    = parts[1::2]
+
+    def render(self, **values: str) -> str:
+        parts = [self._literals[0]]
+
+        # Unknown placeholders are left as they are
+        for name, literal in zip(self._names, self._literals[1:]):
+            parts.append(values[name] if name in values else f"@{name}@")
+            parts.append(literal)
+
+        return "".join(parts)
+
+def load(name: str) -> Template:
+    if name not in _templates:
+        with open(f"{common.DIR_PROMPTS}/{name}.txt", "r") as file:
+            _templates[name] = Template(file.read())
+
+    return _templates[name]
@@ -0,0 +1,81 @@
+import asyncio
+import state
+import unittest
+
+from storage import Config
+from unittest import mock
+
+class JobQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_release_after_waiter_cancelled(self) -> None:
+        queue = state._JobQueue(1)
+        await queue.acquire()
+
+        waiter = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0)
+
+        # The cancelled waiter is still queued when the running job releases its slot
+        waiter.cancel()
+        queue.release()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+
+        self.assertTrue(queue.is_idle())
+
+        await asyncio.wait_for(queue.acquire(), 1)
+        self.assertEqual(queue.get_active(), 1)
+
+    async def test_release_skips_cancelled_waiter(self) -> None:
+        queue = state._JobQueue(1)
+        await queue.acquire()
+
+        cancelled = asyncio.create_task(queue.acquire())
+        waiting   = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        queue.release()
+
+        await asyncio.wait_for(waiting, 1)
+        self.assertEqual(queue.get_active(), 1)
+        self.assertEqual(queue.get_depth(), 0)
+
+class GetStateTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.config     = Config()
+        self.get_config = mock.AsyncMock(side_effect=self._get_config)
+
+        patches = [
+            mock.patch.object(state.storage, "get_config", self.get_config),
+            mock.patch.object(state.storage, "get_analysis_artifacts", mock.AsyncMock(return_value=None)),
+            mock.patch.object(state.storage, "set_analysis_artifacts", mock.AsyncMock()),
+            mock.patch("analysis._get_field_names", mock.AsyncMock(return_value={"steps": "Steps"}))
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def _get_config(self, guild_id: int) -> Config:
+        await asyncio.sleep(0.01)
+        return self.config
+
+    async def test_get_config_on_cold_guild(self) -> None:
+        config = await asyncio.wait_for(state.get_config(1001), 1)
+
+        self.assertIs(config, self.config)
+        self.get_config.assert_awaited_once_with(1001)
+
+    async def test_concurrent_callers_share_init(self) -> None:
+        with mock.patch.object(state.AnalysisSuite, "_init", autospec=True) as suite_init:
+            results = await asyncio.wait_for(asyncio.gather(state.get_config(1002),
+                                                            state.get_analysis_suite(1002),
+                                                            state.get_config(1002)), 1)
+
+        self.assertIs(results[0], self.config)
+        self.assertIs(results[2], self.config)
+        self.get_config.assert_awaited_once_with(1002)
+        suite_init.assert_awaited_once_with(results[1], self.config)
+
+if __name__ == "__main__":
+    unittest.main()